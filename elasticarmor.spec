@@ -54,6 +54,7 @@ Elasticsearch to regulate access to its REST api.
 %attr(0755,root,root) %{_initddir}/%name
 %attr(0750,root,%{name}) %dir %{_sysconfdir}/%{name}
 %attr(0750,%{name},%{name}) %dir %{_localstatedir}/log/%{name}
+%attr(0750,%{name},%{name}) %dir %{_localstatedir}/cache/%{name}
 
 
 %prep
@@ -66,6 +67,7 @@ Elasticsearch to regulate access to its REST api.
 mkdir -p %{buildroot}%{_initddir}
 mkdir -p %{buildroot}%{_sysconfdir}/%{name}
 mkdir -p %{buildroot}%{_localstatedir}/log/%{name}
+mkdir -p %{buildroot}%{_localstatedir}/cache/%{name}
 cp etc/init.d/elasticarmor %{buildroot}%{_initddir}/%{name}
 
 %clean
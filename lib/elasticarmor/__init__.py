@@ -13,6 +13,7 @@ CONFIGURATION_TYPE_ROLE = 'role'
 CONFIGURATION_TYPE_USER = 'user'
 CONFIGURATION_TYPE_ROLE_USER = 'role_user'
 CONFIGURATION_TYPE_ROLE_GROUP = 'role_group'
+CONFIGURATION_TYPE_ROLE_MEMBERSHIP = 'role_membership'
 CONFIGURATION_INDEX_SETTINGS = {
     "settings": {
         "analysis": {
@@ -38,6 +39,10 @@ CONFIGURATION_INDEX_SETTINGS = {
                 "privileges": {
                     "type": "object",
                     "enabled": False
+                },
+                "limits": {
+                    "type": "object",
+                    "enabled": False
                 }
             }
         },
@@ -70,12 +75,21 @@ CONFIGURATION_INDEX_SETTINGS = {
                     "analyzer": "lowercase_keyword"
                 }
             }
+        },
+        CONFIGURATION_TYPE_ROLE_MEMBERSHIP: {
+            "properties": {
+                "roles": {
+                    "type": "string",
+                    "index": "not_analyzed"
+                }
+            }
         }
     }
 }
 
 DEFAULT_CONFIG_DIR = '/etc/elasticarmor'
 DEFAULT_LOGFILE = '/var/log/elasticarmor/elasticarmor.log'
+DEFAULT_SNAPSHOT_FILE = '/var/cache/elasticarmor/snapshot'
 DEFAULT_NODE = 'localhost:9200'
 DEFAULT_ADDRESS = 'localhost'
 DEFAULT_PORT = 59200
@@ -1,17 +1,50 @@
 # ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
 
+import Queue
+import collections
+import itertools
+import errno
 import socket
+import sys
+import threading
+import time
+from array import array
+from multiprocessing.pool import ThreadPool
 
 import requests
 from ldap import LDAPError
 
 from elasticarmor import *
 from elasticarmor.util import format_ldap_error, format_elasticsearch_error
+from elasticarmor.util.cache import Cache
 from elasticarmor.util.elastic import SourceFilter, FilterString, FieldsFilter
 from elasticarmor.util.mixins import LoggingAware
+from elasticarmor.util.snapshot import SnapshotError, read_snapshot, write_snapshot
 
 __all__ = ['AuthorizationError', 'Auth', 'MultipleIncludesError', 'Client']
 
+BACKEND_POOL_SIZE = 8  # Threads, shared by all authentication and group backends
+BACKEND_TIMEOUT = 5  # Seconds, how long to wait for backends to respond unless configured otherwise
+BACKEND_QUEUE_TIMEOUT = 30  # Seconds, how long to wait for a backend call to leave the thread pool's queue
+BACKEND_POLL_INTERVAL = 0.1  # Seconds, how often to check whether queued backend calls have been started
+READ_ONLY_ENDPOINTS = ('/_search', '/_msearch', '/_count', '/_mget', '/_validate', '/_explain', '/_percolate',
+                       '/_mpercolate', '/_suggest', '/_field_stats', '/_mtermvectors', '/_termvector')
+DECISION_CACHE_SIZE = 10000  # Decisions, shared by all clients with the same roles
+RECENT_CLIENTS_LIMIT = 1000  # Clients to warm up caches for upon reload
+RECENT_CLIENTS_TTL = 3600  # Seconds, how long a client is considered recently active
+
+# The parts of a client which are required to warm up caches
+_Identity = collections.namedtuple('_Identity', 'name username groups default_role')
+
+# Keys start with the roles of a client. Roles are replaced when they change, so outdated keys are never hit again
+_decision_cache = Cache(DECISION_CACHE_SIZE)
+_UNKNOWN = object()
+
+
+def _cache_key(value):
+    """Return the given pattern as string so that it can be part of a key of the decision cache."""
+    return value if value is None or isinstance(value, basestring) else str(value)
+
 
 class AuthorizationError(Exception):
     """Base class for all authorization related exceptions."""
@@ -27,6 +60,34 @@ class Auth(LoggingAware, object):
         self.auth_backends = settings.auth_backends
         self.group_backends = settings.group_backends
         self.trusted_proxies = settings.trusted_proxies
+        self.snapshot_file = settings.snapshot_file
+
+        self.configuration_watcher = settings.configuration_watcher
+        self.configuration_watcher.listeners.append(self)
+        self.configuration_watcher.listeners.append(self.role_backend)
+        self.configuration_watcher.listeners.extend(b for b in self.auth_backends if hasattr(b, 'invalidate'))
+
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        self._recent_clients = Cache(RECENT_CLIENTS_LIMIT, RECENT_CLIENTS_TTL)
+        self._system_roles = {}
+        self._reload_pending = False
+        self._reload_thread = None
+        self._reload_lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """The thread pool used to query multiple backends concurrently.
+        Initialized lazily as threads do not survive daemonizing.
+
+        """
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPool(BACKEND_POOL_SIZE)
+
+        return self._executor
 
     def authenticate(self, client, populate=True):
         """Authenticate the given client and return whether it succeeded or not."""
@@ -51,18 +112,10 @@ class Auth(LoggingAware, object):
         else:
             client.name = client.username
             if self.auth_backends:
-                for backend in self.auth_backends:
-                    try:
-                        if backend.authenticate(client):
-                            client.authenticated = True
-                            client.default_role = backend.default_role
-                            break
-                    except LDAPError as error:
-                        self.log.error('Failed to authenticate client "%s" using backend "%s". %s.',
-                                       client, backend.name, format_ldap_error(error))
-                    except requests.RequestException as error:
-                        self.log.error('Failed to authenticate client "%s" using backend "%s". Error: %s.',
-                                       client, backend.name, format_elasticsearch_error(error))
+                backend = self._race_auth_backends(client)
+                if backend is not None:
+                    client.authenticated = True
+                    client.default_role = backend.default_role
             else:
                 trusted_ports = self.trusted_proxies.get(client.peer_address, [])
                 client.authenticated = trusted_ports is None or client.peer_port in trusted_ports
@@ -77,15 +130,8 @@ class Auth(LoggingAware, object):
         if self.group_backends and client.username is not None:
             self.log.debug('Fetching group memberships for client "%s"...', client)
 
-            groups, error = [], None
-            for backend in self.group_backends:
-                try:
-                    groups.extend(backend.get_group_memberships(client))
-                except LDAPError as error:
-                    self.log.error('Failed to fetch ldap group memberships for client "%s" using backend "%s". %s.',
-                                   client, backend.name, format_ldap_error(error))
-
-            if groups or error is None:
+            groups, failed = self._query_group_backends(client)
+            if groups or not failed:
                 client.groups = groups
                 self.log.debug('Client "%s" is a member of the following groups: %s',
                                client, ', '.join(client.groups) or 'None')
@@ -103,9 +149,264 @@ class Auth(LoggingAware, object):
             else:
                 self.log.debug('Client "%s" is a member of the following roles: %s',
                                client, ', '.join(r.id for r in client.roles) or 'None')
+                self._recent_clients.set(client.name, _Identity(client.name, client.username,
+                                                                client.groups, client.default_role))
+
+    def reload(self):
+        """Schedule a reload of all caches in the background. The new caches are warmed up for recently
+        active clients and replace the current ones at once, requests are not paused meanwhile.
+
+        """
+        with self._reload_lock:
+            self._reload_pending = True
+            if self._reload_thread is None:
+                self._reload_thread = threading.Thread(target=self._reload_loop, name='ReloadThread')
+                self._reload_thread.daemon = True
+                self._reload_thread.start()
+
+    def _reload_loop(self):
+        """Reload all caches as long as a reload is pending."""
+        while True:
+            with self._reload_lock:
+                if not self._reload_pending:
+                    self._reload_thread = None
+                    return
+
+                self._reload_pending = False
+
+            self._reload_caches(self._recent_clients.values())
+
+    def _reload_caches(self, clients):
+        """Reload the caches of all backends and warm them up for the given clients."""
+        self.log.debug('Reloading caches for %u recently active client(s)...', len(clients))
+
+        for backend in (b for b in self.group_backends if hasattr(b, 'reload')):
+            backend.reload(clients)
+
+        if self.group_backends:
+            # Group memberships may have changed and are required to warm up the role caches
+            clients = [c._replace(groups=self._query_group_backends(c)[0]) if c.username is not None else c
+                       for c in clients]
+
+        for backend in (b for b in self.auth_backends if hasattr(b, 'reload')):
+            try:
+                backend.reload(clients)
+            except requests.RequestException as error:
+                self.log.error('Failed to reload caches of backend "%s". Error: %s',
+                               backend.name, format_elasticsearch_error(error))
+
+        try:
+            self.role_backend.reload(clients)
+        except requests.RequestException as error:
+            self.log.error('Failed to reload role caches. Error: %s', format_elasticsearch_error(error))
+
+        self.log.info('Reloaded caches for %u recently active client(s).', len(clients))
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        """Persist the cached roles and role memberships as well as all recently active clients."""
+        if self.snapshot_file is None:
+            return
+
+        snapshot = self.role_backend.export_snapshot()
+        snapshot['clients'] = [list(client) for client in self._recent_clients.values()]
+        snapshot['versions'] = self.configuration_watcher.export_snapshot()
+
+        try:
+            write_snapshot(self.snapshot_file, snapshot)
+        except (IOError, OSError) as error:
+            self.log.warning('Failed to write snapshot "%s". An error occurred: %s', self.snapshot_file, error)
+        else:
+            self.log.debug('Wrote snapshot "%s" with %u role(s) and %u recently active client(s).',
+                           self.snapshot_file, len(snapshot['roles']), len(snapshot['clients']))
+
+    def load_snapshot(self):
+        """Load the cached roles and role memberships as well as all recently active clients from the
+        snapshot written last. Returns whether a snapshot has been loaded.
+
+        """
+        if self.snapshot_file is None:
+            return False
+
+        try:
+            snapshot = read_snapshot(self.snapshot_file)
+        except (IOError, OSError) as error:
+            if error.errno != errno.ENOENT:
+                self.log.warning('Failed to read snapshot "%s". An error occurred: %s', self.snapshot_file, error)
+            return False
+        except SnapshotError as error:
+            self.log.warning('Ignoring snapshot. %s', error)
+            return False
+
+        for client in (_Identity(*c) for c in snapshot['clients']):
+            self._recent_clients.set(client.name, client)
+
+        if snapshot['versions'] is None:
+            # Without the versions it is not possible to tell which roles are outdated, so they are fetched again
+            self.log.info('Loaded %u recently active client(s) from snapshot "%s".',
+                          len(snapshot['clients']), self.snapshot_file)
+            self.reload()
+        else:
+            self.configuration_watcher.load_snapshot(snapshot['versions'])
+            self.role_backend.load_snapshot(snapshot)
+            self.log.info('Loaded %u role(s) and %u recently active client(s) from snapshot "%s".',
+                          len(snapshot['roles']), len(snapshot['clients']), self.snapshot_file)
+
+        return True
+
+    def invalidate(self, changes):
+        """Invalidate all cached decisions affected by the given changes of the configuration index."""
+        role_ids = changes.get(CONFIGURATION_TYPE_ROLE)
+        if role_ids:
+            _decision_cache.discard_if(lambda key, _: any(role.id in role_ids for role in key[0]))
+
+    def notice_forwarded_request(self, request):
+        """Notice the given request which has been successfully forwarded to Elasticsearch. In case it
+        may have changed role assignments, a rebuild of the role membership documents is scheduled.
+
+        """
+        if request.command not in ('PUT', 'POST', 'DELETE'):
+            return
+        elif any(endpoint in request.path for endpoint in READ_ONLY_ENDPOINTS):
+            return
+
+        if CONFIGURATION_INDEX in request.path or (
+                request.path.endswith('/_bulk') and CONFIGURATION_INDEX in (request.body or '')):
+            self.log.debug('Request "%s %s" may have changed role assignments.', request.command, request.path)
+            self.role_backend.schedule_membership_rebuild()
+
+    def _authenticate_with(self, backend, client):
+        """Authenticate the given client using the given backend and return whether it succeeded or not."""
+        try:
+            return backend.authenticate(client)
+        except LDAPError as error:
+            self.log.error('Failed to authenticate client "%s" using backend "%s". %s.',
+                           client, backend.name, format_ldap_error(error))
+        except requests.RequestException as error:
+            self.log.error('Failed to authenticate client "%s" using backend "%s". Error: %s.',
+                           client, backend.name, format_elasticsearch_error(error))
+
+        return False
+
+    def _call_backends(self, backends, func, client):
+        """Call the given function with each of the given backends and the given client at once and yield the
+        position of each backend together with the result, as soon as they are available.
+
+        All backends are called using the thread pool. Results which are available at the same time are
+        yielded in the configured order. Backends which do not respond within their timeout, counted from
+        the moment they are called, are yielded with the result _UNKNOWN.
+        Re-raises any unexpected exception which occurs while calling a backend.
+        """
+        results, started = Queue.Queue(), {}
+
+        def call(position, backend):
+            started[position] = time.time()
+            try:
+                results.put((position, func(backend, client), None))
+            except Exception:
+                results.put((position, None, sys.exc_info()))
+
+        submitted_at = time.time()
+        for position, backend in enumerate(backends):
+            self.executor.apply_async(call, (position, backend))
+
+        pending, finished = set(xrange(len(backends))), []
+        while pending:
+            # Results which arrived meanwhile are accepted before any deadline is checked
+            while True:
+                try:
+                    finished.append(results.get_nowait())
+                except Queue.Empty:
+                    break
+
+            for position, result, exc_info in sorted(finished):
+                if position not in pending:
+                    continue  # The backend responded too late
+                elif exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                pending.discard(position)
+                yield position, result
+
+            finished = []
+            if not pending:
+                break
+
+            now = time.time()
+            deadlines = dict((position, started[position] + backends[position].timeout if position in started
+                              else submitted_at + BACKEND_QUEUE_TIMEOUT) for position in pending)
+            for position in sorted(p for p, deadline in deadlines.iteritems() if deadline <= now):
+                self.log.error('Backend "%s" did not respond to a request for client "%s" in time.',
+                               backends[position].name, client)
+                pending.discard(position)
+                yield position, _UNKNOWN
+
+            if not pending:
+                break
+
+            # Calls which are still queued are checked regularly to start their deadline once they are started
+            timeout = min(deadlines[p] for p in pending) - now
+            if any(p not in started for p in pending):
+                timeout = min(timeout, BACKEND_POLL_INTERVAL)
+
+            try:
+                finished.append(results.get(timeout=max(0, timeout)))
+            except Queue.Empty:
+                pass
+
+    def _race_auth_backends(self, client):
+        """Authenticate the given client using all backends at once and return the one which succeeded first.
+
+        If multiple backends succeed at the same time, the one configured first is preferred. Returns
+        None if not a single backend succeeded within its timeout.
+        """
+        if len(self.auth_backends) == 1:
+            backend = self.auth_backends[0]
+            return backend if self._authenticate_with(backend, client) else None
+
+        for position, succeeded in self._call_backends(self.auth_backends, self._authenticate_with, client):
+            if succeeded and succeeded is not _UNKNOWN:
+                return self.auth_backends[position]
+
+    def _fetch_groups_with(self, backend, client):
+        """Fetch and return the group memberships of the given client
+        using the given backend. Returns None if it is not possible.
+
+        """
+        try:
+            return backend.get_group_memberships(client)
+        except LDAPError as error:
+            self.log.error('Failed to fetch ldap group memberships for client "%s" using backend "%s". %s.',
+                           client, backend.name, format_ldap_error(error))
+
+    def _query_group_backends(self, client):
+        """Fetch the group memberships of the given client using all group backends at once.
+
+        Returns the merged groups in the order the backends are configured and whether any backend
+        failed. Backends which do not respond within their timeout are considered failed.
+        """
+        if len(self.group_backends) == 1:
+            groups = self._fetch_groups_with(self.group_backends[0], client)
+            return groups or [], groups is None
+
+        results = dict(self._call_backends(self.group_backends, self._fetch_groups_with, client))
+
+        groups, seen, failed = [], set(), False
+        for position in xrange(len(self.group_backends)):
+            memberships = results[position]
+            if memberships is None or memberships is _UNKNOWN:
+                failed = True
+            else:
+                groups.extend(g for g in memberships if g not in seen)
+                seen.update(memberships)
+
+        return groups, failed
 
     # TODO: Provide a more sophisticated solution, this can't be the only one..
     def _apply_system_defaults(self, client):
+        if client._system_defaults_applied:
+            return  # Clients are kept for the entire connection, the defaults need to be applied only once
+
         permitted_config_types = []
         if client.can('config/authentication'):
             permitted_config_types.append(CONFIGURATION_TYPE_USER)
@@ -115,47 +416,44 @@ class Auth(LoggingAware, object):
             permitted_config_types.append(CONFIGURATION_TYPE_ROLE_GROUP)
 
         if permitted_config_types:
-            from elasticarmor.auth.role import Role
-            if client.is_restricted('indices'):
-                client.roles.append(Role('sysconfig', {
-                    'indices': [{
-                        'permissions': '*',
-                        'include': CONFIGURATION_INDEX,
-                        'types': [{'include': permitted_config_types}]
-                    }]
-                }))
-            else:
-                client.roles.append(Role('sysconfig', {
-                    'indices': [
-                        {
-                            'include': '*',
-                            'exclude': CONFIGURATION_INDEX
-                        },
-                        {
-                            'permissions': '*',
-                            'include': CONFIGURATION_INDEX,
-                            'types': [{'include': permitted_config_types}]
-                        }
-                    ]
-                }))
+            client.roles = client.roles + [
+                self._create_system_role(permitted_config_types, client.is_restricted('indices'))]
         elif not client.is_restricted('indices'):
-            from elasticarmor.auth.role import Role
-            client.roles.append(Role('sysconfig', {
-                'indices': [{
-                    'include': '*',
-                    'exclude': CONFIGURATION_INDEX
-                }]
-            }))
+            client.roles = client.roles + [self._create_system_role(permitted_config_types, False)]
         else:
-            from elasticarmor.auth.role import Pattern
-            pattern = Pattern(CONFIGURATION_INDEX)
-            for restriction in (r for role in client.roles for r in role.get_restrictions()):
-                if restriction.matches(pattern):
-                    restriction.excludes.append(pattern)
+            # Roles are cached and shared between clients, so they must not be altered in place
+            client.roles = [role.exclude_index(CONFIGURATION_INDEX) for role in client.roles]
+
+        client._system_defaults_applied = True
 
-        # TODO: Once this method is not "the" solution anymore, make
-        # sure that this is not required in the new solution as well
-        del client._restricted_scope
+    def _create_system_role(self, permitted_config_types, restricted):
+        """Create and return a role which grants access to the given types of the configuration index.
+        Unrestricted clients are granted access to all other indices as well. Identical roles are only
+        created once, so that clients with the same roles can share their decisions.
+
+        """
+        key = (tuple(permitted_config_types), restricted)
+        try:
+            return self._system_roles[key]
+        except KeyError:
+            pass
+
+        indices = []
+        if not restricted:
+            indices.append({
+                'include': '*',
+                'exclude': CONFIGURATION_INDEX
+            })
+        if permitted_config_types:
+            indices.append({
+                'permissions': '*',
+                'include': CONFIGURATION_INDEX,
+                'types': [{'include': permitted_config_types}]
+            })
+
+        from elasticarmor.auth.role import Role
+        role = self._system_roles[key] = Role('sysconfig', {'indices': indices})
+        return role
 
 
 class MultipleIncludesError(AuthorizationError):
@@ -169,8 +467,11 @@ class MultipleIncludesError(AuthorizationError):
         self.includes = [str(include) for include in includes]
 
 
-class Client(LoggingAware, object):
+class Client(object):
     """An object representing a client who is sending a request."""
+    __slots__ = ('address', 'port', 'peer_address', 'peer_port', 'name', 'authenticated', 'default_role',
+                 'username', 'password', 'groups', '_roles', '_restricted_scope', '_system_defaults_applied',
+                 '_memo')
 
     def __init__(self, address, port=None):
         self.address = address
@@ -185,6 +486,8 @@ class Client(LoggingAware, object):
         self.username = None
         self.password = None
         self.groups = None
+
+        self._memo = {}
         self.roles = None
 
     def __str__(self):
@@ -203,6 +506,25 @@ class Client(LoggingAware, object):
 
         return '%s:%u' % (self.address, self.port)
 
+    @property
+    def roles(self):
+        """The roles this client is a member of."""
+        return self._roles
+
+    @roles.setter
+    def roles(self, roles):
+        self._roles = roles
+        self._system_defaults_applied = False
+        self._memo.clear()
+        try:
+            del self._restricted_scope
+        except AttributeError:
+            pass
+
+    def forget_decisions(self):
+        """Forget all decisions memorized for the current request."""
+        self._memo.clear()
+
     @property
     def restricted_scope(self):
         """The smallest scope within this client is restricted.
@@ -254,7 +576,60 @@ class Client(LoggingAware, object):
         except AttributeError:
             pass
 
-        return any(role.permits(permission, index, document_type, field) for role in self.roles)
+        key = self._decision_key(permission, index, document_type, field)
+        decision = self._get_decision(key)
+        if decision is _UNKNOWN:
+            decision = any(role.permits(permission, index, document_type, field) for role in self.roles)
+            self._set_decision(key, decision)
+
+        return decision
+
+    def forbidden(self, permission, contexts):
+        """Return the contexts in which this client does not have the given permission.
+        Contexts are tuples of index, document type and field and are checked all at once.
+
+        """
+        contexts = list(contexts)
+        keys = [self._decision_key(permission, *context) for context in contexts]
+        decisions = [self._get_decision(key) for key in keys]
+
+        # Only contexts which have not been decided yet are flagged to be checked by the roles
+        pending = array('B', (decision is _UNKNOWN for decision in decisions))
+        if any(pending):
+            for role in self.roles:
+                role.permits_each(permission, contexts, pending)
+                if not any(pending):
+                    break
+
+            for position, decision in enumerate(decisions):
+                if decision is _UNKNOWN:
+                    decisions[position] = not pending[position]
+                    self._set_decision(keys[position], decisions[position])
+
+        return [context for context, decision in itertools.izip(contexts, decisions) if not decision]
+
+    def _decision_key(self, permission, index=None, document_type=None, field=None):
+        """Return the key of the decision for the given permission and context."""
+        return 'can', permission, _cache_key(index), _cache_key(document_type), _cache_key(field)
+
+    def _get_decision(self, key):
+        """Return the decision for the given key or _UNKNOWN if it has not been made yet. Looks in
+        the memo of the current request first and then in the cache shared with other clients.
+
+        """
+        try:
+            return self._memo[key]
+        except KeyError:
+            decision = _decision_cache.get((tuple(self.roles),) + key, _UNKNOWN)
+            if decision is not _UNKNOWN:
+                self._memo[key] = decision
+
+            return decision
+
+    def _set_decision(self, key, decision):
+        """Memorize the given decision for the current request and share it with other clients."""
+        self._memo[key] = decision
+        _decision_cache.set((tuple(self.roles),) + key, decision)
 
     def has_restriction(self, index, document_type=None, without_permission=None):
         """Return whether this client is restricted within the given context.
@@ -270,10 +645,15 @@ class Client(LoggingAware, object):
             except AttributeError:
                 pass
 
-            for role in self.roles:
-                if any(role.get_restrictions(index, document_type, without_permission,
-                                             invert=without_permission is not None)):
-                    return True
+            key = ('restricted', _cache_key(index), _cache_key(document_type), without_permission)
+            decision = self._get_decision(key)
+            if decision is _UNKNOWN:
+                decision = any(any(role.iter_restrictions(index, document_type, without_permission,
+                                                          invert=without_permission is not None))
+                               for role in self.roles)
+                self._set_decision(key, decision)
+
+            return decision
 
         return False
 
@@ -403,13 +783,30 @@ class Client(LoggingAware, object):
         In case of overlapping filters, only those that give the client the broadest access are
         returned. Returns None if not a single role grants access in the given context.
 
+        The result is shared by all clients with the same roles.
         """
+        key = ('filters', permission, _cache_key(index), _cache_key(document_type),
+               tuple(str(p) for p in filter_string.iter_patterns()) if filter_string else None)
+        filters = self._get_decision(key)
+        if filters is _UNKNOWN:
+            filters = self._compute_filters(permission, filter_string, index, document_type)
+            if filters is not None:
+                filters = tuple((include, tuple(excludes)) for include, excludes in filters.iteritems())
+
+            self._set_decision(key, filters)
+
+        if filters is not None:
+            # Callers are free to alter the result, the cached one must stay untouched though
+            return dict((include, list(excludes)) for include, excludes in filters)
+
+    def _compute_filters(self, permission, filter_string=None, index=None, document_type=None):
+        """Helper for method _collect_filters()."""
         from elasticarmor.auth.role import RestrictionsFound  # Placed here to avoid a circular import
 
         filters, involved_roles, indisposed_roles = {}, {}, 0
         for role in self.roles:
             try:
-                restrictions = list(role.get_restrictions(index, document_type, permission))
+                restrictions = role.get_restrictions(index, document_type, permission)
             except RestrictionsFound:
                 # Roles may be able to provide restrictions for the given context but
                 # cannot because the required permission is granted by none of them
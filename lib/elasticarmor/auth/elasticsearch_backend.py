@@ -1,12 +1,24 @@
 # ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
 
 import crypt
+import threading
+import time
 
+import requests
+
+from elasticarmor import *
+from elasticarmor.auth import AuthorizationError
 from elasticarmor.auth.role import Role
-from elasticarmor.util.elastic import ElasticSearchError, ElasticUser
+from elasticarmor.util import format_elasticsearch_error
+from elasticarmor.util.cache import Cache
+from elasticarmor.util.elastic import ElasticSearchError, ElasticUser, ElasticRoleMembership
 from elasticarmor.util.mixins import LoggingAware
 
-__all__ = ['ElasticsearchRoleBackend']
+__all__ = ['ElasticsearchRoleBackend', 'ElasticsearchUserBackend', 'ConfigurationWatcher']
+
+CACHE_TTL = 900  # Seconds, only a safety net as the configuration watcher takes care of invalidation
+DEFAULT_TIMEOUT = 5  # Seconds, how long Elasticsearch may take to look up a user
+WATCH_INTERVAL = 5  # Seconds
 
 
 class ElasticsearchRoleBackend(LoggingAware, object):
@@ -15,37 +27,270 @@ class ElasticsearchRoleBackend(LoggingAware, object):
     def __init__(self, settings):
         self.connection = settings.elasticsearch
 
-    def get_role_memberships(self, client):
+        # Requests read this reference only once, so replacing it does not affect them
+        self._caches = self._create_caches()
+        self._reloading_caches = None
+
+        self._memberships_available = False
+        self._rebuild_pending = False
+        self._rebuild_thread = None
+        self._rebuild_lock = threading.Lock()
+
+    def _create_caches(self):
+        """Create and return a new pair of role and role membership caches."""
+        return Cache(ttl=CACHE_TTL), Cache(ttl=CACHE_TTL)
+
+    def get_role_memberships(self, client, caches=None):
         """Fetch and return all roles the given client is a member of."""
-        request = Role.search(client.name, client.groups)
-        request.params['size'] = 1000  # If you know how to express "unlimited", feel free to change this!
+        role_cache, membership_cache = caches or self._caches
 
-        response = self.connection.process(request)
-        if response is None:
-            return []
+        principals = self._get_principals(client)
+        if self._memberships_available and principals:
+            roles = self._fetch_roles(self._lookup_role_ids(principals, membership_cache), role_cache)
+        else:
+            roles = self._search_roles(client, role_cache)
 
-        response.raise_for_status()
-        result = response.json()
+        if client.default_role is not None and not any(role.id == client.default_role for role in roles):
+            default_roles = self._fetch_roles([client.default_role], role_cache)
+            if default_roles:
+                roles.extend(default_roles)
+            else:
+                self.log.warning('Unable to retrieve default role "%s" for client "%s".', client.default_role, client)
+
+        return roles
+
+    def _get_principals(self, client):
+        """Return the role membership ids of the given client and its groups."""
+        principals = []
+        if client.name:
+            principals.append(ElasticRoleMembership.create_id('user', client.name))
+        if client.groups:
+            principals.extend(ElasticRoleMembership.create_id('group', group) for group in client.groups)
+
+        return principals
 
+    def _search_roles(self, client, role_cache):
+        """Search and return all roles the given client is a member of by utilizing a parent/child query."""
         roles = []
-        for hit in result.get('hits', {}).get('hits', []):
+        for hit in self.connection.scroll(Role.search(client.name, client.groups)):
             try:
-                roles.append(Role.from_search_result(hit))
+                role = Role.from_search_result(hit)
             except ElasticSearchError as error:
                 self.log.warning('Failed to create role from search result. An error occurred: %s', error)
+            else:
+                role_cache.set(role.id, role)  # It is up to date, in contrast to a role which may be cached
+                roles.append(role)
 
-        if client.default_role is not None and not any(role.id == client.default_role for role in roles):
-            response = self.connection.process(Role.get_source(client.default_role))
-            if response is not None and response.ok:
+        return roles
+
+    def _lookup_role_ids(self, principals, membership_cache):
+        """Look up and return the ids of all roles the given principals are a member of."""
+        role_ids, missing = set(), []
+        for principal in principals:
+            cached_ids = membership_cache.get(principal)
+            if cached_ids is None:
+                missing.append(principal)
+            else:
+                role_ids.update(cached_ids)
+
+        if missing:
+            response = self.connection.process(ElasticRoleMembership.multi_get(missing))
+            if response is None:
+                return []
+
+            response.raise_for_status()
+
+            for document in response.json().get('docs', []):
+                # Principals without any membership are cached as well, they are the most common ones
+                found_ids = document.get('_source', {}).get('roles', []) if document.get('found') else []
+                membership_cache.set(document['_id'], found_ids)
+                role_ids.update(found_ids)
+
+        return sorted(role_ids)
+
+    def _fetch_roles(self, role_ids, role_cache):
+        """Fetch and return the roles with the given ids."""
+        roles, missing = [], []
+        for role_id in role_ids:
+            role = role_cache.get(role_id)
+            if role is None:
+                missing.append(role_id)
+            else:
+                roles.append(role)
+
+        if not missing:
+            return roles
+
+        response = self.connection.process(Role.multi_get(missing, _source='privileges,limits'))
+        if response is None:
+            return roles
+
+        response.raise_for_status()
+
+        for document in response.json().get('docs', []):
+            if document.get('found'):
                 try:
-                    roles.append(Role.from_source(client.default_role, response.json()))
+                    role = Role.from_search_result(document)
                 except ElasticSearchError as error:
-                    self.log.warning('Failed to create role from source. An error occurred: %s', error)
-            else:
-                self.log.warning('Unable to retrieve default role "%s" for client "%s".', client.default_role, client)
+                    self.log.warning('Failed to create role from multi get result. An error occurred: %s', error)
+                else:
+                    role_cache.set(role.id, role)
+                    roles.append(role)
 
         return roles
 
+    def reload(self, clients):
+        """Replace all cached roles and role memberships at once with new ones.
+
+        The new caches are warmed up for the given clients first and their roles are
+        compiled, so that requests do not have to wait for Elasticsearch afterwards.
+        """
+        caches = self._reloading_caches = self._create_caches()
+        role_cache, membership_cache = caches
+
+        try:
+            if self._memberships_available:
+                principals = set(p for client in clients for p in self._get_principals(client))
+                role_ids = set(self._lookup_role_ids(principals, membership_cache))
+                role_ids.update(client.default_role for client in clients if client.default_role is not None)
+                roles = self._fetch_roles(sorted(role_ids), role_cache)
+            else:
+                roles = [r for client in clients for r in self.get_role_memberships(client, caches)]
+
+            for role in roles:
+                try:
+                    role.get_restricted_scope()  # Compiles the role's privileges
+                except AuthorizationError as error:
+                    self.log.warning('Role "%s" is invalid. An error occurred: %s', role.id, error)
+        finally:
+            self._reloading_caches = None
+
+        self._caches = caches
+        self.log.debug('Reloaded %u role(s) and %u role membership(s).', len(role_cache), len(membership_cache))
+
+    def export_snapshot(self):
+        """Return all cached roles and role memberships in a JSON serializable form."""
+        role_cache, membership_cache = self._caches
+        return {
+            'roles': dict((role_id, role.privileges) for role_id, role in role_cache.items()),
+            'limits': dict((role_id, role.limits) for role_id, role in role_cache.items() if role.limits),
+            'memberships': dict(membership_cache.items()),
+            'memberships_available': self._memberships_available
+        }
+
+    def load_snapshot(self, snapshot):
+        """Replace all cached roles and role memberships with the ones of the given snapshot."""
+        role_cache, membership_cache = caches = self._create_caches()
+        limits = snapshot.get('limits', {})  # Snapshots of previous versions do not contain any limits
+        for role_id, privileges in snapshot['roles'].iteritems():
+            role = Role(role_id, privileges, limits.get(role_id))
+            try:
+                role.get_restricted_scope()  # Compiles the role's privileges
+            except AuthorizationError as error:
+                self.log.warning('Role "%s" is invalid. An error occurred: %s', role_id, error)
+            else:
+                role_cache.set(role_id, role)
+
+        for membership_id, role_ids in snapshot['memberships'].iteritems():
+            membership_cache.set(membership_id, role_ids)
+
+        self._caches = caches
+        self._memberships_available = snapshot['memberships_available']
+
+    def invalidate(self, changes):
+        """Invalidate all cached data affected by the given changes of the configuration index."""
+        role_ids = changes.get(CONFIGURATION_TYPE_ROLE)
+        membership_ids = changes.get(CONFIGURATION_TYPE_ROLE_USER, set()) | \
+            changes.get(CONFIGURATION_TYPE_ROLE_GROUP, set())
+
+        for role_cache, membership_cache in filter(None, (self._caches, self._reloading_caches)):
+            if role_ids:
+                role_cache.discard(*role_ids)
+            if membership_ids:
+                membership_cache.discard(*membership_ids)
+
+        if role_ids:
+            self.log.debug('Invalidated cached role(s): %s', ', '.join(role_ids))
+        if membership_ids:
+            self.log.debug('Invalidated cached role membership(s): %s', ', '.join(membership_ids))
+            self.schedule_membership_rebuild()
+
+    def rebuild_memberships(self):
+        """Rebuild the role membership documents based on all role_user and role_group documents.
+        Returns the role ids of every principal which is a member of at least one role.
+
+        """
+        memberships = {}
+        for hit in self.connection.scroll(ElasticRoleMembership.search_assignments()):
+            role_id = hit.get('_parent') or hit.get('fields', {}).get('_parent')
+            if isinstance(role_id, list):
+                role_id = role_id[0] if role_id else None
+
+            name = hit.get('_source', {}).get('name')
+            if not role_id or not name:
+                self.log.warning('Ignoring incomplete role assignment "%r".', hit)
+                continue
+
+            principal_type = 'user' if hit.get('_type') == CONFIGURATION_TYPE_ROLE_USER else 'group'
+            membership_id = ElasticRoleMembership.create_id(principal_type, name)
+            membership = memberships.setdefault(membership_id, ElasticRoleMembership(membership_id, set()))
+            membership.roles.add(role_id)
+
+        obsolete_ids = [hit['_id'] for hit in self.connection.scroll(ElasticRoleMembership.search_ids())
+                        if hit['_id'] not in memberships]
+
+        if memberships or obsolete_ids:
+            response = self.connection.process(
+                ElasticRoleMembership.bulk_update(memberships.itervalues(), obsolete_ids))
+            if response is None:
+                raise requests.ConnectionError('None of the configured Elasticsearch nodes is reachable')
+
+            response.raise_for_status()
+            if response.json().get('errors'):
+                raise ElasticSearchError('Failed to store one or more role membership documents')
+
+        self.log.debug('Rebuilt %u role membership(s), removed %u obsolete one(s).',
+                       len(memberships), len(obsolete_ids))
+        return dict((membership_id, m.roles) for membership_id, m in memberships.iteritems())
+
+    def schedule_membership_rebuild(self):
+        """Schedule a rebuild of the role membership documents in the background.
+        Multiple calls while a rebuild is running result in a single subsequent rebuild.
+
+        """
+        with self._rebuild_lock:
+            self._rebuild_pending = True
+            if self._rebuild_thread is None:
+                self._rebuild_thread = threading.Thread(target=self._rebuild_memberships_loop,
+                                                        name='MembershipRebuildThread')
+                self._rebuild_thread.daemon = True
+                self._rebuild_thread.start()
+
+    def _rebuild_memberships_loop(self):
+        """Rebuild the role membership documents as long as a rebuild is pending."""
+        while True:
+            with self._rebuild_lock:
+                if not self._rebuild_pending:
+                    self._rebuild_thread = None
+                    return
+
+                self._rebuild_pending = False
+
+            try:
+                memberships = self.rebuild_memberships()
+            except (requests.RequestException, ElasticSearchError) as error:
+                # Until the next successful rebuild the potentially outdated documents must not be used
+                self._memberships_available = False
+                self.log.error('Failed to rebuild role memberships. Falling back to search roles on'
+                               ' demand. An error occurred: %s', format_elasticsearch_error(error))
+            else:
+                # Lookups which took place during the rebuild may have cached outdated memberships
+                for _, membership_cache in filter(None, (self._caches, self._reloading_caches)):
+                    membership_cache.discard_if(lambda principal, role_ids: set(role_ids) != memberships.get(
+                        principal, set()))
+
+                self._memberships_available = True
+
 
 class ElasticsearchUserBackend(LoggingAware, object):
     """Elasticsearch backend class providing user account related operations."""
@@ -53,25 +298,69 @@ class ElasticsearchUserBackend(LoggingAware, object):
     def __init__(self, name, get_option, settings):
         self.connection = settings.elasticsearch
         self.name = name
+        self.timeout = DEFAULT_TIMEOUT
+
+        self._user_cache = Cache(ttl=CACHE_TTL)
+        self._reloading_cache = None
 
     def authenticate(self, client):
         """Authenticate the given client and return whether it succeeded or not."""
-        response = self.connection.process(ElasticUser.get_source(client.name))
-        if response is None:
-            return False
-
-        if not response.ok:
-            if response.status_code == 404:
+        user_cache = self._user_cache
+        name = client.name.decode('utf-8', 'replace') if isinstance(client.name, str) else client.name
+        user = user_cache.get(name)
+        if user is None:
+            request = ElasticUser.get_source(client.name)
+            request.deadline = time.time() + self.timeout
+            response = self.connection.process(request)
+            if response is None:
                 return False
 
-            response.raise_for_status()
+            if not response.ok:
+                if response.status_code == 404:
+                    return False
+
+                response.raise_for_status()
+
+            user = ElasticUser.from_source(client.name, response.json())
+            user_cache.set(name, user)
 
-        user = ElasticUser.from_source(client.name, response.json())
         return self._compare_hashes(
             self._hash_password(client.password, self._extract_salt(user.password_hash)),
             user.password_hash
         )
 
+    def reload(self, clients):
+        """Replace all cached user accounts at once with the ones of the given clients."""
+        user_cache = self._reloading_cache = Cache(ttl=CACHE_TTL)
+
+        try:
+            names = [client.name for client in clients if client.username is not None]
+            response = self.connection.process(ElasticUser.multi_get(names)) if names else None
+            if response is not None:
+                response.raise_for_status()
+                for document in response.json().get('docs', []):
+                    if document.get('found'):
+                        try:
+                            user_cache.set(document['_id'], ElasticUser.from_source(document['_id'],
+                                                                                    document['_source']))
+                        except ElasticSearchError as error:
+                            self.log.warning('Failed to create user from multi get result. An error'
+                                             ' occurred: %s', error)
+        finally:
+            self._reloading_cache = None
+
+        self._user_cache = user_cache
+        self.log.debug('Reloaded %u user account(s) of backend "%s".', len(user_cache), self.name)
+
+    def invalidate(self, changes):
+        """Invalidate all cached user accounts affected by the given changes of the configuration index."""
+        user_ids = changes.get(CONFIGURATION_TYPE_USER)
+        if user_ids:
+            for user_cache in (c for c in (self._user_cache, self._reloading_cache) if c is not None):
+                user_cache.discard(*user_ids)
+
+            self.log.debug('Invalidated cached user account(s): %s', ', '.join(user_ids))
+
     def _hash_password(self, password, salt):
         """Hash the given password with the given salt and return the result."""
         return crypt.crypt(password, '$1$' + salt)
@@ -83,3 +372,141 @@ class ElasticsearchUserBackend(LoggingAware, object):
     def _compare_hashes(self, a, b):
         """Return whether the given hashes match."""
         return a == b
+
+
+class ConfigurationWatcher(LoggingAware, object):
+    """Watches the configuration index for modifications and notifies listeners about changed documents.
+
+    The indexing statistics of the index are polled as a cheap indicator for modifications. Only if they
+    change, the versions of all documents are fetched and compared with the ones seen before. Listeners
+    are then passed a dictionary of document types and the ids of the changed documents by calling their
+    method invalidate(). For role assignments, the ids are those of the affected role memberships.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.listeners = []
+
+        self._counters = None
+        self._versions = None
+        self._thread = None
+        self._terminator = threading.Event()
+
+    def start(self):
+        """Start watching the configuration index in the background."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='ConfigurationWatcherThread')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop watching the configuration index."""
+        self._terminator.set()
+
+    def _watch(self):
+        """Poll the configuration index until stopped."""
+        while not self._terminator.is_set():
+            try:
+                self.poll()
+            except (requests.RequestException, ElasticSearchError, ValueError) as error:
+                # Forgetting the counters ensures that the versions are compared once the index is reachable again
+                self._counters = None
+                self.log.warning('Failed to check the configuration index for modifications. An error'
+                                 ' occurred: %s', format_elasticsearch_error(error))
+
+            self._terminator.wait(WATCH_INTERVAL)
+
+    def poll(self):
+        """Check the configuration index for modifications and notify all listeners about them."""
+        counters = self._fetch_counters()
+        if counters is None or counters == self._counters:
+            return
+
+        # Modifications are not visible to searches until the index has been refreshed
+        response = self.connection.process(requests.Request('POST', '/' + CONFIGURATION_INDEX + '/_refresh'))
+        if response is None:
+            raise requests.ConnectionError('None of the configured Elasticsearch nodes is reachable')
+
+        response.raise_for_status()
+
+        versions = self._fetch_versions()
+        if self._versions is not None:
+            changes = self._compare_versions(self._versions, versions)
+            if changes:
+                self.log.debug('Detected modifications of the configuration index: %r', changes)
+                for listener in self.listeners:
+                    listener.invalidate(changes)
+
+        self._versions = versions
+        self._counters = counters
+
+    def export_snapshot(self):
+        """Return the versions of all watched documents seen last in a JSON serializable form."""
+        versions = self._versions
+        if versions is not None:
+            return [list(key) + list(value) for key, value in versions.iteritems()]
+
+    def load_snapshot(self, versions):
+        """Use the given versions of a snapshot to detect modifications which took place in the meantime."""
+        self._versions = dict(((t, p, i), (v, n)) for t, p, i, v, n in versions)
+        self._counters = None
+
+    def _fetch_counters(self):
+        """Fetch and return the indexing counters of the configuration index.
+        Returns None in case the configuration index does not exist.
+
+        """
+        response = self.connection.process(requests.Request(
+            'GET', '/' + CONFIGURATION_INDEX + '/_stats/indexing',
+            params={'filter_path': 'indices.*.primaries.indexing.index_total,'
+                                   'indices.*.primaries.indexing.delete_total'}))
+        if response is None:
+            raise requests.ConnectionError('None of the configured Elasticsearch nodes is reachable')
+        elif response.status_code == 404:
+            return
+
+        response.raise_for_status()
+
+        indexing = response.json().get('indices', {}).get(CONFIGURATION_INDEX, {})
+        indexing = indexing.get('primaries', {}).get('indexing', {})
+        return indexing.get('index_total'), indexing.get('delete_total')
+
+    def _fetch_versions(self):
+        """Fetch and return the versions and names of all watched documents."""
+        request = requests.Request(
+            'GET', '/{0}/{1},{2},{3},{4}/_search'.format(CONFIGURATION_INDEX, CONFIGURATION_TYPE_ROLE,
+                                                         CONFIGURATION_TYPE_USER, CONFIGURATION_TYPE_ROLE_USER,
+                                                         CONFIGURATION_TYPE_ROLE_GROUP),
+            params={'version': 'true', 'fields': '_parent', '_source': 'name',
+                    'filter_path': '_scroll_id,hits.hits._id,hits.hits._type,hits.hits._version,'
+                                   'hits.hits._parent,hits.hits.fields,hits.hits._source'})
+
+        versions = {}
+        for hit in self.connection.scroll(request):
+            parent = hit.get('_parent') or hit.get('fields', {}).get('_parent')
+            if isinstance(parent, list):
+                parent = parent[0] if parent else None
+
+            versions[(hit['_type'], parent, hit['_id'])] = hit.get('_version'), hit.get('_source', {}).get('name')
+
+        return versions
+
+    def _compare_versions(self, old_versions, new_versions):
+        """Compare the given versions and return the ids of all changed documents, grouped by type."""
+        changes = {}
+        for key in set(old_versions) | set(new_versions):
+            old, new = old_versions.get(key), new_versions.get(key)
+            if old == new:
+                continue
+
+            document_type, _, document_id = key
+            if document_type in (CONFIGURATION_TYPE_ROLE_USER, CONFIGURATION_TYPE_ROLE_GROUP):
+                # Both, the previous and the current name, are affected by a changed role assignment
+                principal_type = 'user' if document_type == CONFIGURATION_TYPE_ROLE_USER else 'group'
+                for _, name in (v for v in (old, new) if v is not None and v[1]):
+                    changes.setdefault(document_type, set()).add(
+                        ElasticRoleMembership.create_id(principal_type, name))
+            else:
+                changes.setdefault(document_type, set()).add(document_id)
+
+        return changes
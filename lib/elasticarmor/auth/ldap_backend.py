@@ -5,11 +5,14 @@ import threading
 
 import ldap
 
+from elasticarmor.util import format_ldap_error
+from elasticarmor.util.mixins import LoggingAware
 from elasticarmor.util.rwlock import ReadWriteLock, Protector
 
 __all__ = ['LdapBackend', 'LdapUserBackend', 'LdapUsergroupBackend']
 
 CACHE_INVALIDATION_INTERVAL = 900  # Seconds
+DEFAULT_TIMEOUT = 5  # Seconds, prevents unreachable or hanging servers from blocking a thread forever
 
 
 class LdapBackend(object):
@@ -26,6 +29,7 @@ class LdapBackend(object):
         self.url = get_option('url')
         self.bind_dn = get_option('bind_dn')
         self.bind_pw = get_option('bind_pw')
+        self.timeout = DEFAULT_TIMEOUT
 
     @property
     def _local(self):
@@ -46,6 +50,8 @@ class LdapBackend(object):
         """
         if self._local.connection is None:
             self._local.connection = ldap.initialize(self.url)
+            self._local.connection.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)  # Only limits connecting
+            self._local.connection.set_option(ldap.OPT_TIMEOUT, self.timeout)  # Limits waiting for results
 
         return self._local.connection
 
@@ -150,7 +156,7 @@ class LdapUserBackend(LdapBackend):
             self.unbind()
 
 
-class LdapUsergroupBackend(LdapBackend):
+class LdapUsergroupBackend(LoggingAware, LdapBackend):
     """LDAP backend class providing usergroup related operations."""
 
     def __init__(self, name, get_option, settings):
@@ -188,27 +194,61 @@ class LdapUsergroupBackend(LdapBackend):
         if membership_cache is not None and membership_cache['expires'] > now:
             memberships = membership_cache['memberships']
         else:
+            memberships = self._fetch_group_memberships(client.name)
             with self._cache_lock.writeContext:
-                self.bind()
-                user_filter = self.render_search_filter({'objectClass': self.user_object_class,
-                                                         self.user_name_attribute: client.name})
-                if self.user_object_filter is not None:
-                    user_filter = '(&({0}){1})'.format(self.user_object_filter, user_filter)
-
-                user_dn = self.fetch_dn(self.user_base_dn, user_filter)
-                group_filter = self.render_search_filter({'objectClass': self.group_object_class,
-                                                          self.group_membership_attribute: user_dn})
-                if self.group_object_filter is not None:
-                    group_filter = '(&({0}){1})'.format(self.group_object_filter, group_filter)
-
-                results = self.search(self.group_base_dn, group_filter, [self.group_name_attribute])
-                memberships = []
-                for result in (r for r in results if self.group_name_attribute in r[1]):
-                    memberships.extend(result[1][self.group_name_attribute])
                 self._group_cache[client.name] = {
                     'memberships': memberships,
                     'expires': now + CACHE_INVALIDATION_INTERVAL
                 }
-                self.unbind()
+
+        return memberships
+
+    def reload(self, clients):
+        """Replace the internal group membership cache at once with one of the given clients.
+        Clients whose group memberships cannot be fetched are omitted from the new cache.
+
+        """
+        group_cache = {}
+        for client in (c for c in clients if c.username is not None):
+            try:
+                memberships = self._fetch_group_memberships(client.name)
+            except ldap.LDAPError as error:
+                self.log.warning('Failed to fetch group memberships of client "%s" using backend "%s". %s.',
+                                 client.name, self.name, format_ldap_error(error))
+            else:
+                group_cache[client.name] = {
+                    'memberships': memberships,
+                    'expires': time.time() + CACHE_INVALIDATION_INTERVAL
+                }
+
+        with self._cache_lock.writeContext:
+            self._group_cache = group_cache
+
+        self.log.debug('Reloaded %u group membership(s) of backend "%s".', len(group_cache), self.name)
+
+    def _fetch_group_memberships(self, name):
+        """Fetch and return all usergroups the user with the given name is a member of.
+        No lock is required as each thread binds using its own connection.
+
+        """
+        self.bind()
+        try:
+            user_filter = self.render_search_filter({'objectClass': self.user_object_class,
+                                                     self.user_name_attribute: name})
+            if self.user_object_filter is not None:
+                user_filter = '(&({0}){1})'.format(self.user_object_filter, user_filter)
+
+            user_dn = self.fetch_dn(self.user_base_dn, user_filter)
+            group_filter = self.render_search_filter({'objectClass': self.group_object_class,
+                                                      self.group_membership_attribute: user_dn})
+            if self.group_object_filter is not None:
+                group_filter = '(&({0}){1})'.format(self.group_object_filter, group_filter)
+
+            results = self.search(self.group_base_dn, group_filter, [self.group_name_attribute])
+            memberships = []
+            for result in (r for r in results if self.group_name_attribute in r[1]):
+                memberships.extend(result[1][self.group_name_attribute])
+        finally:
+            self.unbind()
 
         return memberships
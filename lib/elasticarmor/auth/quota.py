@@ -0,0 +1,187 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import math
+import threading
+import time
+
+from elasticarmor.util.cache import Cache
+from elasticarmor.util.mixins import LoggingAware
+
+__all__ = ['QuotaExceeded', 'QuotaManager']
+
+QUOTA_STATE_LIMIT = 10000  # Quotas, the least recently used ones are dropped once exceeded
+QUOTA_STATE_TTL = 3600  # Seconds, how long the state of an unused quota is kept
+QUOTA_SCOPES = ('client', 'address', 'role')
+QUOTA_LIMITS = ('rate', 'burst', 'concurrency')
+
+
+class QuotaExceeded(Exception):
+    """Raised by method QuotaManager.acquire() in case a client exceeds one of its quotas."""
+
+    def __init__(self, reason, retry_after):
+        super(QuotaExceeded, self).__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Quota(object):
+    """The state and usage counters of a single role's limits for a client, an address or all its members.
+
+    The rate limit is implemented as token bucket. It holds up to burst tokens, one of which is consumed
+    by each request, and is refilled by rate tokens per second.
+    """
+
+    __slots__ = ('role', 'scope', 'key', 'rate', 'burst', 'concurrency', 'tokens', 'updated_at',
+                 'active', 'admitted', 'throttled', 'rejected')
+
+    def __init__(self, role, scope, key):
+        self.role = role
+        self.scope = scope
+        self.key = key
+
+        self.rate = None
+        self.burst = None
+        self.concurrency = None
+        self.tokens = None
+        self.updated_at = None
+
+        self.active = 0
+        self.admitted = 0
+        self.throttled = 0
+        self.rejected = 0
+
+    def refill(self, now):
+        """Add the tokens which accumulated since the last refill and return how many are available."""
+        if self.tokens is None:
+            self.tokens = self.burst
+        else:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+
+        self.updated_at = now
+        return self.tokens
+
+    def to_json(self):
+        """Return this quota's limits, state and counters in a JSON serializable form."""
+        return {
+            'role': self.role,
+            'scope': self.scope,
+            'key': self.key,
+            'rate': self.rate,
+            'burst': self.burst,
+            'concurrency': self.concurrency,
+            'tokens': self.tokens,
+            'active': self.active,
+            'admitted': self.admitted,
+            'throttled': self.throttled,
+            'rejected': self.rejected
+        }
+
+
+class QuotaManager(LoggingAware, object):
+    """Applies the rate limits and concurrency quotas defined by the roles of clients."""
+
+    def __init__(self):
+        self._quotas = Cache(QUOTA_STATE_LIMIT, QUOTA_STATE_TTL)
+        self._active_quotas = {}  # Quotas in use are kept here as well, so that they cannot be evicted
+        self._lock = threading.Lock()
+
+    def _get_quotas(self, client):
+        """Return the quotas which apply to the given client, with up to date limits."""
+        quotas = []
+        for role in client.roles:
+            if not self._defines_quota(role):
+                continue
+
+            try:
+                scope = role.limits.get('per', 'client')
+                if scope not in QUOTA_SCOPES:
+                    raise ValueError('Unknown scope "{0}"'.format(scope))
+
+                rate = float(role.limits['rate']) if role.limits.get('rate') is not None else None
+                burst = float(role.limits['burst']) if role.limits.get('burst') is not None else rate
+                concurrency = int(role.limits['concurrency']) if role.limits.get('concurrency') is not None else None
+                if rate is not None and (rate <= 0 or burst < 1) or concurrency is not None and concurrency < 1:
+                    raise ValueError('Limits must be greater than zero and a burst must be at least one')
+            except (AttributeError, TypeError, ValueError) as error:
+                self.log.warning('Role "%s" defines invalid limits. An error occurred: %s', role.id, error)
+                continue
+
+            if scope == 'client':
+                key = str(client)
+            elif scope == 'address':
+                key = client.address
+            else:
+                key = None
+
+            cache_key = (role.id, scope, key)
+            quota = self._active_quotas.get(cache_key) or self._quotas.get(cache_key) or Quota(role.id, scope, key)
+            self._quotas.set(cache_key, quota)  # Extends the time-to-live of quotas which are in use
+
+            quota.rate, quota.burst, quota.concurrency = rate, burst, concurrency
+            quotas.append(quota)
+
+        return quotas
+
+    def acquire(self, client):
+        """Account a new request of the given client and return the quotas it occupies.
+        Raises QuotaExceeded if any of the client's quotas is exhausted, without occupying any.
+
+        """
+        if not any(self._defines_quota(role) for role in client.roles):
+            return []
+
+        with self._lock:
+            quotas, now = self._get_quotas(client), time.time()
+            for quota in quotas:
+                if quota.concurrency is not None and quota.active >= quota.concurrency:
+                    quota.rejected += 1
+                    raise QuotaExceeded('Role "{0}" permits only {1} concurrent request(s){2}.'.format(
+                        quota.role, quota.concurrency, self._describe_scope(quota)), 1)
+                elif quota.rate is not None and quota.refill(now) < 1:
+                    quota.throttled += 1
+                    raise QuotaExceeded('Role "{0}" permits only {1:g} request(s) per second{2}.'.format(
+                        quota.role, quota.rate, self._describe_scope(quota)),
+                        int(math.ceil((1 - quota.tokens) / quota.rate)))
+
+            for quota in quotas:
+                if quota.rate is not None:
+                    quota.tokens -= 1
+                quota.admitted += 1
+                quota.active += 1
+                self._active_quotas[(quota.role, quota.scope, quota.key)] = quota
+
+            return quotas
+
+    def release(self, quotas):
+        """Release the given quotas which have been acquired earlier."""
+        with self._lock:
+            for quota in quotas:
+                quota.active -= 1
+                if not quota.active:
+                    cache_key = (quota.role, quota.scope, quota.key)
+                    self._active_quotas.pop(cache_key, None)
+                    self._quotas.set(cache_key, quota)  # Unused quotas expire from now on
+
+    def get_usage(self):
+        """Return the limits, state and counters of all quotas in a JSON serializable form."""
+        with self._lock:
+            quotas = dict(((q.role, q.scope, q.key), q) for q in self._quotas.values())
+            quotas.update(self._active_quotas)
+            return [quota.to_json() for quota in quotas.itervalues()]
+
+    @staticmethod
+    def _defines_quota(role):
+        """Return whether the limits of the given role define a quota. Caps and budgets do not need to be tracked."""
+        try:
+            return any(role.limits.get(name) is not None for name in QUOTA_LIMITS)
+        except AttributeError:
+            return bool(role.limits)  # Invalid, but reported as such once the limits are parsed
+
+    @staticmethod
+    def _describe_scope(quota):
+        """Return a short description of who is sharing the given quota."""
+        if quota.scope == 'client':
+            return ' per client'
+        elif quota.scope == 'address':
+            return ' per address'
+        return ' for all its members'
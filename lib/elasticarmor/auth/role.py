@@ -1,6 +1,7 @@
 # ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
 
 import operator
+import threading
 
 from elasticarmor.auth import AuthorizationError
 from elasticarmor.util import pattern_compare
@@ -8,6 +9,57 @@ from elasticarmor.util.elastic import ElasticRole
 
 __all__ = ['RoleError', 'RestrictionsFound', 'Role', 'RestrictionError', 'Restriction', 'Pattern']
 
+CONTEXT_PATTERN_CACHE_SIZE = 10000
+
+
+class _PermissionRegistry(object):
+    """Registry which interns permission names as bits, so that checking whether any of
+    a restriction's permissions grants a required permission is a single bitwise AND.
+
+    Every granted permission is assigned a bit once. For a required permission, the bits of all
+    granted permissions which match it are computed on first use and are extended lazily once
+    further permissions are granted. The matching itself is done by Role._match_permissions().
+    """
+
+    def __init__(self):
+        self._bits = {}
+        self._granted = []
+        self._masks = {}
+        self._lock = threading.Lock()
+
+    def register(self, granted_permissions):
+        """Register the given granted permissions and return the mask of their bits."""
+        mask = 0
+        for permission in granted_permissions:
+            try:
+                mask |= self._bits[permission]
+            except KeyError:
+                with self._lock:
+                    if permission not in self._bits:
+                        self._granted.append(permission)
+                        self._bits[permission] = 1 << (len(self._granted) - 1)
+
+                mask |= self._bits[permission]
+
+        return mask
+
+    def granted_by(self, required_permission):
+        """Return the mask of all granted permissions which match the given required permission."""
+        mask, known = self._masks.get(required_permission, (0, 0))
+        if known < len(self._granted):
+            granted = self._granted[known:]
+            for position, permission in enumerate(granted, known):
+                if Role._match_permissions(required_permission, permission):
+                    mask |= 1 << position
+
+            self._masks[required_permission] = mask, known + len(granted)
+
+        return mask
+
+
+_permissions = _PermissionRegistry()
+_context_patterns = {}
+
 
 class RoleError(AuthorizationError):
     """Raised by class Role in case of an error."""
@@ -70,7 +122,8 @@ class Role(ElasticRole):
             if not cluster and not indices and not types and not fields:
                 raise RoleError('Role "{0}" does not define any privileges'.format(self.id))
 
-            self.__privileges = {'cluster': cluster, 'indices': indices, 'types': types, 'fields': fields}
+            self.__privileges = {'cluster': cluster, 'cluster_mask': _permissions.register(cluster),
+                                 'indices': indices, 'types': types, 'fields': fields}
             return self.__privileges
 
     def get_restricted_scope(self):
@@ -85,22 +138,57 @@ class Role(ElasticRole):
         elif self._privileges['indices']:
             return 'indices'
 
+    def exclude_index(self, pattern):
+        """Return a copy of this role whose index restrictions exclude the given pattern.
+        Roles are shared between clients, so a copy is created only once per pattern.
+
+        """
+        try:
+            derived_roles = self.__derived_roles
+        except AttributeError:
+            derived_roles = self.__derived_roles = {}
+
+        pattern = Pattern(pattern)
+        try:
+            return derived_roles[str(pattern)]
+        except KeyError:
+            role = Role(self.id, self.privileges, self.limits)
+            for restriction in role.get_restrictions():
+                if restriction.matches(pattern):
+                    restriction.excludes.append(pattern)
+
+            derived_roles[str(pattern)] = role
+            return role
+
     def get_restrictions(self, index=None, document_type=None, permission=None, invert=False):
-        """Return all restrictions for the given context which do or do not grant the given permission.
-        Climbs up the entire privilege hierarchy in case a restriction inherits permissions
-        until a partially matching parent is found that grants the permission.
+        """Return a list of all restrictions for the given context which do or do not grant the given permission.
+        Raises RestrictionsFound under the same conditions as method iter_restrictions().
+
+        """
+        return list(self.iter_restrictions(index, document_type, permission, invert))
+
+    def iter_restrictions(self, index=None, document_type=None, permission=None, invert=False):
+        """Return a generator for all restrictions for the given context which do or do not grant the given
+        permission. Climbs up the entire privilege hierarchy in case a restriction inherits permissions
+        until a partially matching parent is found that grants the permission. Restrictions are produced
+        as soon as they are found, so existence checks can stop at the first one.
 
         Raises RestrictionsFound in case a permission is given, invert is False and restrictions
-        were found but none of them grant the required permission.
+        were found but none of them grant the required permission. As this can only be known
+        once all restrictions have been checked, it is raised when the generator is exhausted.
         """
-        restrictions, candidates, restrictions_found = [], [], False
+        found, candidates, restrictions_found, required = False, [], False, 0
+        if permission is not None:
+            self._privileges  # Ensures that the role's permissions are registered before looking up the mask
+            required = _permissions.granted_by(permission)
         if document_type is not None:
             pattern = Pattern.from_context(index, document_type)
             for restriction in self._privileges['fields']:
                 if restriction.matches(pattern):
                     if permission is None:
                         # If there is no permission it's the restriction itself we're interested in
-                        restrictions.append(restriction)
+                        found = True
+                        yield restriction
                     elif not restriction.permissions:
                         # Restrictions without any permissions are considered inheriting
                         candidates.append(restriction)
@@ -108,22 +196,24 @@ class Role(ElasticRole):
                         restrictions_found = True
                         # Whereas restrictions with at least one permission
                         # are required to match and if not, are ignored...
-                        if any(self._match_permissions(permission, p) for p in restriction.permissions):
-                            restrictions.append(restriction)
-                    elif invert and not any(self._match_permissions(permission, p) for p in restriction.permissions):
+                        if restriction.permission_mask & required:
+                            found = True
+                            yield restriction
+                    elif invert and not restriction.permission_mask & required:
                         # ...unless we're inverting the match, of course
-                        restrictions.append(restriction)
+                        found = True
+                        yield restriction
 
             if not candidates:
                 # Stop here in case there are not any remaining candidates as there is nothing else to collect
-                if restrictions_found and not restrictions:
+                if restrictions_found and not found:
                     # There were matching restrictions, but none of them grant
                     # the required permission, so signal this to the caller
                     raise RestrictionsFound()
 
-                return restrictions
+                return
 
-        if index is not None and (not restrictions or candidates):
+        if index is not None and (not found or candidates):
             if candidates:
                 # If there are already candidates, ensure that these are not touched and
                 # use a pattern that represents the full context to avoid false-positives
@@ -136,7 +226,8 @@ class Role(ElasticRole):
             for restriction in self._privileges['types']:
                 if restriction.matches(pattern):
                     if permission is None:
-                        restrictions.append(restriction)
+                        found = True
+                        yield restriction
                     elif not restriction.permissions:
                         if register_candidates:
                             candidates.append(restriction)
@@ -144,38 +235,44 @@ class Role(ElasticRole):
                         if register_candidates:
                             restrictions_found = True
 
-                        if any(self._match_permissions(permission, p) for p in restriction.permissions):
+                        if restriction.permission_mask & required:
                             if register_candidates:
                                 # Avoid touching the restrictions as well, since we're
                                 # interested in the remaining candidates only
-                                restrictions.append(restriction)
+                                found = True
+                                yield restriction
                             elif candidates:
                                 # Any matching parent allows to include the remaining
                                 # candidates in the final result, at once
-                                restrictions.extend(candidates)
-                                return restrictions
+                                found = True
+                                for candidate in candidates:
+                                    yield candidate
+                                return
                     elif invert:
-                        if any(self._match_permissions(permission, p) for p in restriction.permissions):
+                        if restriction.permission_mask & required:
                             if not register_candidates and candidates:
                                 # The restriction obviously grants the permission and since that's not
                                 # what we're out for in case the match is inverted it means that all
                                 # remaining candidates now have it as well and as such are obsolete
-                                return restrictions
+                                return
                         elif register_candidates:
-                            restrictions.append(restriction)
+                            found = True
+                            yield restriction
                         elif candidates:
                             # In case of a failed inverted match and remaining candidates
                             # we'll stop at the first parent that is not inheriting as well
-                            restrictions.extend(candidates)
-                            return restrictions
+                            found = True
+                            for candidate in candidates:
+                                yield candidate
+                            return
 
             if not candidates:
-                if restrictions_found and not restrictions:
+                if restrictions_found and not found:
                     raise RestrictionsFound()
 
-                return restrictions
+                return
 
-        if not restrictions or candidates:
+        if not found or candidates:
             if candidates:
                 register_candidates = False
                 pattern = Pattern.from_context(index)
@@ -186,81 +283,145 @@ class Role(ElasticRole):
             for restriction in self._privileges['indices']:
                 if pattern is None or restriction.matches(pattern):
                     if permission is None:
-                        restrictions.append(restriction)
+                        found = True
+                        yield restriction
                     elif not restriction.permissions:
                         if register_candidates:
-                            restrictions.append(restriction)
+                            found = True
+                            yield restriction
                     elif not invert:
                         if register_candidates:
                             restrictions_found = True
 
-                        if any(self._match_permissions(permission, p) for p in restriction.permissions):
+                        if restriction.permission_mask & required:
                             if register_candidates:
-                                restrictions.append(restriction)
+                                found = True
+                                yield restriction
                             elif candidates:
-                                restrictions.extend(candidates)
-                                return restrictions
+                                found = True
+                                for candidate in candidates:
+                                    yield candidate
+                                return
                     elif invert:
-                        if any(self._match_permissions(permission, p) for p in restriction.permissions):
+                        if restriction.permission_mask & required:
                             if not register_candidates and candidates:
-                                return restrictions
+                                return
                         elif register_candidates:
-                            restrictions.append(restriction)
+                            found = True
+                            yield restriction
                         elif candidates:
-                            restrictions.extend(candidates)
-                            return restrictions
+                            found = True
+                            for candidate in candidates:
+                                yield candidate
+                            return
 
         if candidates:
             if not invert:
-                if any(self._match_permissions(permission, p) for p in self._privileges['cluster']):
-                    restrictions.extend(candidates)
-            elif not any(self._match_permissions(permission, p) for p in self._privileges['cluster']):
-                restrictions.extend(candidates)
-
-        if restrictions_found and not restrictions:
+                if self._privileges['cluster_mask'] & required:
+                    found = True
+                    for candidate in candidates:
+                        yield candidate
+            elif not self._privileges['cluster_mask'] & required:
+                found = True
+                for candidate in candidates:
+                    yield candidate
+
+        if restrictions_found and not found:
             raise RestrictionsFound()
 
-        # TODO: Return a generator instead
-        return restrictions
-
     def permits(self, permission, index=None, document_type=None, field=None):
         """Return whether this role permits the given permission in the given context.
         May return True if the permission has been granted at a higher level.
 
         """
         if field is not None:
-            field_match = self._grants_permission(permission, self.get_restrictions(index, document_type),
+            field_match = self._grants_permission(permission, self.iter_restrictions(index, document_type),
                                                   Pattern.from_context(index, document_type, field))
             if field_match is not None:
                 return field_match
 
         if document_type is not None:
-            type_match = self._grants_permission(permission, self.get_restrictions(index),
+            type_match = self._grants_permission(permission, self.iter_restrictions(index),
                                                  Pattern.from_context(index, document_type))
             if type_match is not None:
                 return type_match
 
         if index is not None:
-            index_match = self._grants_permission(permission, self.get_restrictions(),
+            index_match = self._grants_permission(permission, self.iter_restrictions(),
                                                   Pattern.from_context(index))
             if index_match is not None:
                 return index_match
 
-        return any(self._match_permissions(permission, p) for p in self._privileges['cluster'])
+        return bool(self._privileges['cluster_mask'] & _permissions.granted_by(permission))
+
+    def permits_each(self, permission, contexts, pending):
+        """Clear the flag of each context in which this role permits the given permission.
+
+        Contexts are tuples of index, document type and field and pending is an array with one flag
+        per context. Contexts whose flag is already cleared are skipped. Decisions on the index and
+        type level are made only once for all contexts sharing the same index or document type.
+        """
+        cluster_match = self.permits(permission)
+        index_restrictions = None
+        restrictions, matches = {}, {}
+        for position, (index, document_type, field) in enumerate(contexts):
+            if not pending[position]:
+                continue
+
+            match = None
+            if field is not None:
+                key = (str(index), str(document_type))
+                try:
+                    type_restrictions = restrictions[key]
+                except KeyError:
+                    type_restrictions = restrictions[key] = self.get_restrictions(index, document_type)
+
+                match = self._grants_permission(permission, type_restrictions,
+                                                Pattern.from_context(index, document_type, field))
+
+            if match is None and document_type is not None:
+                key = (str(index), str(document_type))
+                try:
+                    match = matches[key]
+                except KeyError:
+                    if str(index) not in restrictions:
+                        restrictions[str(index)] = self.get_restrictions(index)
+
+                    match = matches[key] = self._grants_permission(permission, restrictions[str(index)],
+                                                                   Pattern.from_context(index, document_type))
+
+            if match is None and index is not None:
+                try:
+                    match = matches[str(index)]
+                except KeyError:
+                    if index_restrictions is None:
+                        index_restrictions = self.get_restrictions()
+
+                    match = matches[str(index)] = self._grants_permission(permission, index_restrictions,
+                                                                          Pattern.from_context(index))
+
+            if match if match is not None else cluster_match:
+                pending[position] = 0
 
     def _grants_permission(self, permission, privileges, pattern=None):
-        """Helper for method permit()."""
-        if not privileges:
-            return
+        """Helper for method permit(). Privileges may be any iterable, which is consumed
+        only until a restriction granting the permission is found.
 
-        check_parents = False
+        """
+        privileges_found = check_parents = False
+        self._privileges  # Privileges may be compiled lazily, their permissions must be registered beforehand
+        required = _permissions.granted_by(permission)
         for restriction in privileges:
+            privileges_found = True
             if pattern is None or restriction.matches(pattern):
                 if not restriction.permissions:
                     check_parents = True
-                elif any(self._match_permissions(permission, p) for p in restriction.permissions):
+                elif restriction.permission_mask & required:
                     return True
 
+        if not privileges_found:
+            return
+
         return None if check_parents else False
 
     @staticmethod
@@ -286,9 +447,11 @@ class RestrictionError(AuthorizationError):
 
 class Restriction(object):
     """Restriction object which represents a configured client restriction."""
+    __slots__ = ('permissions', 'permission_mask', 'excludes', 'includes', 'parent')
 
     def __init__(self, includes, excludes=None, permissions=None, parent=None):
         self.permissions = permissions or []
+        self.permission_mask = _permissions.register(self.permissions)
         self.excludes = excludes or []
         self.includes = includes
         self.parent = parent
@@ -377,9 +540,10 @@ class Restriction(object):
 # TODO: Comments. This is way too much magic to remain uncommented...
 class Pattern(object):
     """Pattern container which provides methods to perform rich comparisons with other patterns."""
+    __slots__ = ('pattern', 'parent')
 
     def __init__(self, pattern, parent=None):
-        self.pattern = str(pattern)
+        self.pattern = intern(str(pattern))
         self.parent = parent
 
     def __str__(self):
@@ -393,7 +557,17 @@ class Pattern(object):
 
     @classmethod
     def from_context(cls, index, document_type=None, field=None):
-        """Create and return a new instance of Pattern using the given context."""
+        """Return a instance of Pattern for the given context. As neither patterns
+        nor restrictions are altered once created, instances are shared.
+
+        """
+        key = (cls, str(index), None if document_type is None else str(document_type),
+               None if document_type is None or field is None else str(field))
+        try:
+            return _context_patterns[key]
+        except KeyError:
+            pass
+
         pattern = cls(index)
         if document_type is not None:
             index_restriction = Restriction([pattern])
@@ -401,6 +575,10 @@ class Pattern(object):
             if field is not None:
                 pattern = cls(field, parent=Restriction([pattern], parent=index_restriction))
 
+        if len(_context_patterns) >= CONTEXT_PATTERN_CACHE_SIZE:
+            _context_patterns.clear()  # Cheaper than tracking which ones are used least
+
+        _context_patterns[key] = pattern
         return pattern
 
     def _compare(self, other, op, incompatible=False):
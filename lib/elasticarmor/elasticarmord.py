@@ -31,13 +31,12 @@ class ElasticArmor(UnixDaemon, LoggingAware):
     def handle_reload(self):
         self.log.info('Reloading request handler caches...')
         ElasticRequest.clear_caches()
-        if self._proxy.auth.group_backends:
-            self.log.info('Reloading group membership cache...')
-            for backend in self._proxy.auth.group_backends:
-                try:
-                    backend.clear_cache()
-                except AttributeError:
-                    pass
+
+        self.log.info('Rebuilding role memberships...')
+        self._proxy.auth.role_backend.schedule_membership_rebuild()
+
+        self.log.info('Reloading authentication and authorization caches in the background...')
+        self._proxy.auth.reload()
 
     def run(self):
         self.log.info('Launching reverse proxy...')
@@ -2,10 +2,12 @@
 
 import base64
 import os
+import select
 import socket
 import ssl
 import sys
 import threading
+import time
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from SocketServer import ThreadingMixIn
 from urllib import unquote
@@ -15,6 +17,7 @@ import requests
 
 from elasticarmor import *
 from elasticarmor.auth import AuthorizationError, Auth, Client
+from elasticarmor.auth.quota import QuotaExceeded, QuotaManager
 from elasticarmor.request import ElasticRequest, RequestError
 from elasticarmor.util import format_elasticsearch_error
 from elasticarmor.util.elastic import ElasticSearchError
@@ -26,6 +29,8 @@ CONNECTION_TIMEOUT = 5  # Seconds
 CONNECTION_REQUEST_LIMIT = 100
 CONTENT_BUFFER_SIZE = 2**16  # Bytes, 64KiB
 MAX_CHUNK_SIZE = 4096  # Bytes, used when transferring response payloads
+RETRY_AFTER = 1  # Seconds, suggested to clients whose requests are refused due to overload
+DISCONNECT_CHECK_INTERVAL = 0.5  # Seconds, how often to check whether a client is still waiting for a response
 DENSE_ERROR_FORMAT = '{"error":"[%(app)s] %(explain)s","status":%(code)d}'
 PRETTY_ERROR_FORMAT = '''{
   "error" : "[%(app)s] %(explain)s",
@@ -34,12 +39,97 @@ PRETTY_ERROR_FORMAT = '''{
 '''
 
 
+class ClientDisconnected(Exception):
+    """Raised by the request handler in case a client disconnects before its response has been sent."""
+    pass
+
+
+class UpstreamRequest(LoggingAware, threading.Thread):
+    """Forwards a request to Elasticsearch in the background.
+
+    This allows the request handler to watch its client while waiting for a response and to abandon
+    the request if the client disconnects. The response of an abandoned request is closed once it arrives.
+    As Elasticsearch keeps processing a request whose connection is closed, an abandoned request is still
+    considered to occupy whatever has been acquired for it, until it has finished in the background.
+    """
+
+    def __init__(self, elasticsearch, request):
+        super(UpstreamRequest, self).__init__(name='UpstreamRequest')
+        self.daemon = True
+
+        self.elasticsearch = elasticsearch
+        self.request = request
+        self.finished = threading.Event()
+
+        self._lock = threading.Lock()
+        self._done = False
+        self._release = None
+        self._response = None
+        self._exc_info = None
+
+    def run(self):
+        response = exc_info = None
+        try:
+            idempotent = self.request.is_idempotent()
+            response = self.elasticsearch.process(self.request, coalesce=idempotent, hedge=idempotent)
+        except Exception:
+            exc_info = sys.exc_info()
+
+        release = None
+        with self._lock:
+            self._done = True
+            if self.request.abandoned:
+                if response is not None:
+                    self.log.debug('Discarding response to abandoned request "%s %s"...',
+                                   self.request.command, self.request.path)
+                    response.close()
+                release = self._release
+            else:
+                self._response, self._exc_info = response, exc_info
+                self.finished.set()
+
+        if release is not None:
+            release()
+
+    def abandon(self, release=None):
+        """Abandon the request, closing its response if it has already been received. The given
+        function is called once the request has finished, which may be right away or later on.
+
+        """
+        with self._lock:
+            self.request.abandoned = True
+            if self._response is not None:
+                self._response.close()
+            if not self._done:
+                self._release = release
+                return
+
+        if release is not None:
+            release()
+
+    def get_response(self):
+        """Return the response of Elasticsearch or re-raise the error which prevented to receive it."""
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        return self._response
+
+
 class ElasticReverseProxy(LoggingAware, ThreadingMixIn, HTTPServer):
     def __init__(self, settings):
         self._terminator = threading.Event()
 
         self.auth = Auth(settings)
         self.elasticsearch = settings.elasticsearch
+        self.cluster_metadata = settings.cluster_metadata
+        self.node_sniffer = settings.node_sniffer
+        self.response_cache = settings.response_cache
+        self.search_result_cache = settings.search_result_cache
+        self.admission_controller = settings.admission_controller
+        self.request_timeout = settings.request_timeout
+        self.response_compressor = settings.response_compressor
+        self.quota_manager = QuotaManager()
         self.skip_index_initialization = settings.options.skip_index_initialization
 
         listen_address = settings.listen_address
@@ -85,6 +175,14 @@ class ElasticReverseProxy(LoggingAware, ThreadingMixIn, HTTPServer):
         if not self.skip_index_initialization:
             self._initialize_configuration_index()
 
+        self.auth.load_snapshot()
+        self.auth.role_backend.schedule_membership_rebuild()
+        self.auth.configuration_watcher.start()
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.start()
+        if self.node_sniffer is not None:
+            self.node_sniffer.start()
+
         self.server_bind()
         self.log.debug('Bound TCP socket to "%s"...', self.server_address[0])
         self.server_activate()
@@ -105,6 +203,11 @@ class ElasticReverseProxy(LoggingAware, ThreadingMixIn, HTTPServer):
     def shutdown(self):
         self.log.debug('Stopping to serve incoming requests...')
         self._terminator.set()
+        self.auth.configuration_watcher.stop()
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.stop()
+        if self.node_sniffer is not None:
+            self.node_sniffer.stop()
         HTTPServer.shutdown(self)
 
         for thread in threading.enumerate():
@@ -118,6 +221,8 @@ class ElasticReverseProxy(LoggingAware, ThreadingMixIn, HTTPServer):
         self.server_close()
         self.log.debug('Closed socket.')
 
+        self.auth.save_snapshot()
+
 
 class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
     keep_alive_hint = 'timeout={0}, max={1}'.format(CONNECTION_TIMEOUT, CONNECTION_REQUEST_LIMIT)
@@ -133,6 +238,8 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
         self._context = None
         self._client = None
         self._body = None
+        self._quotas = None
+        self._admitted = False
 
         self.options = None
 
@@ -181,6 +288,14 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
                 self.send_error(413, explain=str(error))
             except socket.error as error:
                 self.log.debug('Failed to send error response to "%s". An error occurred: %s', client_address, error)
+        except requests.Timeout as error:
+            self.log.warning('Request "%s %s" of client "%s" timed out. Error: %s',
+                             self.command, self.path, self.client, error)
+
+            try:
+                self.send_error(504, explain='Elasticsearch did not respond in time.')
+            except socket.error as error:
+                self.log.debug('Failed to send error response to "%s". An error occurred: %s', client_address, error)
         except requests.RequestException as error:
             self.log.error('An error occurred while communicating with Elasticsearch: %s',
                            format_elasticsearch_error(error))
@@ -190,6 +305,10 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
                                              ' Please contact an administrator.')
             except socket.error as error:
                 self.log.debug('Failed to send error response to "%s". An error occurred: %s', client_address, error)
+        except ClientDisconnected:
+            self.log.info('Client "%s" disconnected before receiving a response to request "%s %s".',
+                          self.client, self.command, self.path)
+            self.close_connection = True
         except socket.error as error:
             self.log.error('Connection to client "%s" broke. An error occurred: %s', self.client, error)
         except Exception:
@@ -430,6 +549,12 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
             self.send_error(403, explain='You\'re not permitted to access this realm.')
             return
 
+        try:
+            self._quotas = self.server.quota_manager.acquire(self.client)
+        except QuotaExceeded as error:
+            self.send_error(429, 'Too Many Requests', error.reason, {'Retry-After': error.retry_after})
+            return
+
         request = ElasticRequest.create_request(self._context, path=path if path else '/', query=query)
         if request is None:
             # TODO: Elasticsearch responds with text/plain, not application/json!
@@ -440,15 +565,53 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
         return request
 
     def handle_one_request(self):
-        request = self.fetch_request()
-        if request is None:
-            return
+        try:
+            request = self.fetch_request()
+            if request is None:
+                return
+
+            # Requests are admitted only after being read and authenticated, otherwise idle keep-alive connections
+            # and unknown clients would occupy the slots, while clients exceeding their quotas are refused earlier
+            admission_controller = self.server.admission_controller
+            if admission_controller is None:
+                self.handle_request(request)
+            elif not admission_controller.acquire():
+                self.log.warning('Refusing request "%s %s" of client "%s" due to overload. (%u active, %u waiting)',
+                                 self.command, self.path, self.client, admission_controller.active,
+                                 admission_controller.waiting)
+                self.send_error(503, explain='Too many concurrent requests. Please try again later.',
+                                headers={'Retry-After': RETRY_AFTER})
+            else:
+                self._admitted = True
+                self.handle_request(request)
+        finally:
+            release = self._detach_occupancy()
+            release()
+
+    def _detach_occupancy(self):
+        """Return a function releasing the quotas and the admission slot occupied by the current request.
+        Calling it is up to the caller from now on.
+
+        """
+        quotas, admitted = self._quotas, self._admitted
+        self._quotas, self._admitted = None, False
 
-        # TODO: Is this really required for *every* request??
+        def release():
+            if admitted:
+                self.server.admission_controller.release()
+            if quotas:
+                self.server.quota_manager.release(quotas)
+
+        return release
+
+    def handle_request(self, request):
+        self.client.forget_decisions()
         self.server.auth._apply_system_defaults(self.client)
 
         try:
             response = request.inspect(self.client)
+            if response is None:
+                request.set_deadline(self.client, self.server.request_timeout)
         except RequestError as error:
             self.send_error(error.status_code, explain=error.reason)
             return
@@ -463,16 +626,33 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
                 403, explain='An error occurred while checking your authorization. Please contact an administrator.')
             return
 
+        search_result_cache = self.server.search_result_cache
+        response_cache = search_result_cache if request.result_cache else self.server.response_cache
+        if response is None and response_cache is not None:
+            response = response_cache.fetch(request)
+            if response is not None:
+                self.log.debug('Serving cached response for request "%s %s"...', self.command, self.path)
+
         if response is None:
             self.log.debug('Forwarding request "%s %s" to Elasticsearch...', self.command, self.path)
             request.headers.extend_via_field(self.protocol_version, APP_NAME)
-            response = self.server.elasticsearch.process(request)
+            started_at = time.time()
+            response = self.forward_request(request)
+            if self.server.admission_controller is not None:
+                self.server.admission_controller.observe(time.time() - started_at)
             if response is None:
                 self.log.debug('No response received from any of the configured Elasticsearch nodes.')
                 self.send_error(504, explain='No response received from any of the configured Elasticsearch nodes.')
                 return
 
             forwarded = True
+            if response.ok:
+                self.server.auth.notice_forwarded_request(request)
+                if self.server.response_cache is not None:
+                    self.server.response_cache.notice_forwarded_request(request)
+                if search_result_cache is not None:
+                    search_result_cache.notice_forwarded_request(request)
+
             # Convert the response's header object so that we can use our own utilities. The original
             # object is overwritten to avoid a differentiation between it and the new one in the
             # context object. If this causes issues, feel free to refactor it.
@@ -481,6 +661,9 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
             response.options = response.headers.extract_connection_options()
             if response.options:
                 self.log.debug('Extracted connection options: %s', response.options)
+
+            if response_cache is not None:
+                response = response_cache.store(request, response)
         else:
             forwarded = False
             # The response is ours so we have to add the Server and Date header..
@@ -498,7 +681,28 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
             response.status_code = 203
             response.headers['Warning'] = '214 {0} "{1}"'.format(self.server_version, transformation_reason)
 
-        stream = request.transform(response.raw.stream(MAX_CHUNK_SIZE, decode_content=False), MAX_CHUNK_SIZE)
+        decode_content = False
+        if response.headers.get('Content-Encoding', 'identity').lower() != 'identity' and request.transforms_payload():
+            # The payload can only be transformed once decoded, its length will then change as well
+            decode_content = True
+            del response.headers['Content-Encoding']
+            if 'Content-Length' in response.headers:
+                del response.headers['Content-Length']
+
+        stream = request.transform(response.raw.stream(MAX_CHUNK_SIZE, decode_content=decode_content),
+                                   MAX_CHUNK_SIZE)
+
+        response_compressor = self.server.response_compressor
+        if response_compressor is not None and self.command != 'HEAD' and response_compressor.is_compressible(response):
+            coding = response_compressor.negotiate(self.headers.get('Accept-Encoding'))
+            if coding is not None:
+                response.headers['Content-Encoding'] = coding
+                response.headers['Vary'] = ', '.join(filter(None, [response.headers.get('Vary'), 'Accept-Encoding']))
+                if 'Content-Length' in response.headers:
+                    del response.headers['Content-Length']
+
+                stream = response_compressor.compress(stream, coding)
+
         data = next(stream, None)
         if data and ('Content-Length' not in response.headers or int(response.headers['Content-Length']) == 0):
             chunked_content = self.request_version >= 'HTTP/1.1'
@@ -529,11 +733,21 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
 
             try:
                 self.wfile.write(prepare_chunk(data) if chunked_content else data)
+                checked_at = time.time()
                 for data in stream:
+                    if time.time() - checked_at > DISCONNECT_CHECK_INTERVAL:
+                        if self.client_disconnected():
+                            raise ClientDisconnected()
+                        checked_at = time.time()
+
                     self.wfile.write(prepare_chunk(data) if chunked_content else data)
 
                 if chunked_content:
                     self.wfile.write(close_chunks())
+            except (ClientDisconnected, socket.error):
+                if isinstance(response, requests.Response):
+                    response.close()  # Stop receiving what the client doesn't want anymore
+                raise
             finally:
                 try:
                     stream.close()  # Required to be compliant with PEP 333
@@ -543,6 +757,43 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
         action = 'Forwarded response from Elasticsearch' if forwarded else 'Successfully provided response'
         self.log.info('%s for request "%s %s" to client "%s".', action, self.command, self.path, self.client)
 
+    def forward_request(self, request):
+        """Send the given request to Elasticsearch and return its response. Returns None if it was not
+        possible to receive a response. Raises ClientDisconnected if the client disconnects meanwhile.
+
+        """
+        upstream = UpstreamRequest(self.server.elasticsearch, request)
+        upstream.start()
+        while not upstream.finished.wait(DISCONNECT_CHECK_INTERVAL):
+            if self.client_disconnected():
+                # Elasticsearch is still busy with the request, so its quotas and slot are released once it's done
+                upstream.abandon(self._detach_occupancy())
+                raise ClientDisconnected()
+
+        return upstream.get_response()
+
+    def client_disconnected(self):
+        """Return whether the client has closed its connection.
+
+        A client which only shut down its sending side is considered disconnected as well. HTTP clients
+        do not do this while awaiting a response, as it's not distinguishable from closing the connection.
+
+        """
+        # Peek at the underlying socket in case of a secured connection, as its encrypted data is not of interest
+        connection = getattr(self.connection, '_sock', self.connection)
+
+        try:
+            # Unlike select(), poll() is not limited to file descriptors below FD_SETSIZE
+            poller = select.poll()
+            poller.register(connection, select.POLLIN)
+            events = poller.poll(0)
+            if events and events[0][1] & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                return True
+
+            return bool(events) and not connection.recv(1, socket.MSG_PEEK)
+        except (select.error, socket.error, ValueError):
+            return True
+
     def finish(self):
         # TODO: http://tools.ietf.org/html/rfc7230#section-6.6 (The last three paragraphs)
 
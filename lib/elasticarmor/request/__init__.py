@@ -1,8 +1,11 @@
 # ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
 
+import hashlib
 import os
 import re
 import sys
+import time
+import urllib
 from functools import update_wrapper
 
 # We need object_pairs_hook, which is only available in the json module since Python 2.7
@@ -13,10 +16,17 @@ else:
     import simplejson as json
     from simplejson import OrderedDict
 
+from elasticarmor.auth import READ_ONLY_ENDPOINTS
+from elasticarmor.util import pattern_match, parse_time_value, format_time_value
+from elasticarmor.util.cache import Cache
 from elasticarmor.util.http import HttpHeaders
 from elasticarmor.util.mixins import LoggingAware
 
-__all__ = ['RequestError', 'PermissionError', 'Permission', 'Permissions', 'ElasticResponse', 'ElasticRequest']
+__all__ = ['RequestError', 'PermissionError', 'Permission', 'Permissions', 'ElasticResponse', 'ResponseCache',
+           'SearchResultCache', 'ElasticRequest']
+
+RESPONSE_CACHE_ENTRY_LIMIT = 2**20  # Bytes, 1MiB
+DEADLINE_MARGIN = 0.5  # Seconds, left to Elasticsearch to respond once the injected timeout expired
 
 
 class _RequestRegistry(type):
@@ -220,6 +230,168 @@ class ElasticResponse(object):
             self._streaming = True
 
 
+class ResponseCache(LoggingAware, object):
+    """Cache for the responses of Elasticsearch to requests whose handler defines a cache_ttl.
+
+    Responses are keyed by the request's path and query as they are after the inspection. As request
+    handlers rewrite these according to what a client is permitted to access, clients with the same
+    permissions share the same entries. Only complete and successful responses are cached.
+    """
+
+    def __init__(self, max_size):
+        self._cache = Cache(max_size)
+        self.entry_limit = RESPONSE_CACHE_ENTRY_LIMIT
+
+    def __len__(self):
+        return len(self._cache)
+
+    @staticmethod
+    def _create_key(request):
+        """Return the key of the given request or None if its response must not be cached."""
+        if request.cache_ttl is None or request.command not in ('GET', 'HEAD') or request.body:
+            return
+
+        return (request.command, request.path, urllib.urlencode(request.query, True),
+                request.headers.get('Accept-Encoding'))
+
+    def _get_ttl(self, request):
+        """Return for how many seconds the response to the given request should be cached."""
+        return request.cache_ttl
+
+    def fetch(self, request):
+        """Return the cached response for the given request or None if there is none."""
+        key = self._create_key(request)
+        if key is None:
+            return
+
+        entry = self._cache.get(key)
+        if entry is not None:
+            status_code, reason, headers, content = entry
+
+            response = ElasticResponse()
+            response.status_code = status_code
+            response.reason = reason
+            response.content = content
+            for header_name, header_value in headers:
+                response.headers[header_name] = header_value
+
+            return response
+
+    def store(self, request, response):
+        """Cache the given response to the given request, if possible. As the response's payload is consumed
+        in this case, a cached copy is returned. Otherwise the given response is returned untouched.
+
+        """
+        key = self._create_key(request)
+        if key is None or response.status_code != 200:
+            return response
+
+        try:
+            content_length = int(response.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return response  # Chunked responses are of unknown size, so they're not cached
+
+        if content_length > self.entry_limit:
+            return response
+
+        content = response.raw.read(decode_content=False) if content_length and request.command != 'HEAD' else ''
+        self._cache.set(key, (response.status_code, response.reason, response.headers.items(), content),
+                        self._get_ttl(request))
+        return self.fetch(request)
+
+    def notice_forwarded_request(self, request):
+        """Notice the given request which has been successfully forwarded to Elasticsearch.
+        In case it may have altered any metadata, all cached responses are dropped.
+
+        """
+        if request.invalidates_cache and len(self._cache):
+            self.log.debug('Request "%s %s" may have altered metadata. Clearing response cache.',
+                           request.command, request.path)
+            self._cache.clear()
+
+
+class SearchResultCache(ResponseCache):
+    """Cache for the responses of Elasticsearch to requests whose handler sets result_cache to True.
+
+    Other than the ResponseCache, requests are also keyed by a digest of their body and the cache's size is
+    limited by the number of bytes its responses occupy. Requests which use a scroll, a preference or which
+    disable Elasticsearch's request cache are not cached. Once a request is forwarded that may have changed
+    documents, all responses of requests targeting affected indices are dropped.
+    """
+
+    def __init__(self, max_bytes, ttl, index_ttls=None):
+        self._cache = Cache(max_bytes, sizeof=self._get_entry_size)
+        self.entry_limit = min(RESPONSE_CACHE_ENTRY_LIMIT, max_bytes)
+        self.index_ttls = index_ttls or []
+        self.ttl = ttl
+
+    @staticmethod
+    def _get_entry_size(entry):
+        """Return roughly how many bytes the given entry occupies."""
+        status_code, reason, headers, content = entry
+        return len(content) + len(reason or '') + sum(len(name) + len(value) for name, value in headers)
+
+    @staticmethod
+    def _get_indices(path):
+        """Return the names of the indices the given path refers to or None if it refers to all of them."""
+        index_filter = path.lstrip('/').split('/', 1)[0]
+        if index_filter and not index_filter.startswith('_'):
+            indices = [index.lstrip('+') for index in urllib.unquote(index_filter).split(',')
+                       if not index.startswith('-')]
+            if '*' not in indices:
+                return indices
+
+    @staticmethod
+    def _create_key(request):
+        """Return the key of the given request or None if its response must not be cached."""
+        if not request.result_cache or request.command not in ('GET', 'POST'):
+            return
+        elif 'scroll' in request.query or 'preference' in request.query:
+            return  # Scrolls are stateful and a preference is usually used to pin a client to particular shards
+        elif request.query.is_false('request_cache', False) or request.query.is_false('query_cache', False):
+            return
+
+        return (request.command, request.path, urllib.urlencode(request.query, True),
+                request.headers.get('Accept-Encoding'), hashlib.sha1(request.body or '').hexdigest())
+
+    def _get_ttl(self, request):
+        """Return for how many seconds the response to the given request should be cached."""
+        indices = self._get_indices(request.path)
+        if indices is None:
+            return self.ttl
+
+        return min(next((ttl for pattern, ttl in self.index_ttls if pattern_match(pattern, index)), self.ttl)
+                   for index in indices)
+
+    def notice_forwarded_request(self, request):
+        """Notice the given request which has been successfully forwarded to Elasticsearch. In case it
+        may have changed documents, all cached responses of requests for affected indices are dropped.
+
+        """
+        if request.invalidates_cache:
+            super(SearchResultCache, self).notice_forwarded_request(request)
+            return
+        elif request.command not in ('PUT', 'POST', 'DELETE') or not len(self._cache):
+            return
+        elif any(endpoint in request.path for endpoint in READ_ONLY_ENDPOINTS):
+            return
+
+        # Bulk requests may refer to any index in their body, so we'll have to assume they affect all of them
+        indices = None if request.path.endswith('/_bulk') else self._get_indices(request.path)
+        if indices is None:
+            self.log.debug('Request "%s %s" may have changed documents of any index. Clearing search result cache.',
+                           request.command, request.path)
+            self._cache.clear()
+        else:
+            self._cache.discard_if(lambda key, _: self._affects(indices, key[1]))
+
+    def _affects(self, indices, path):
+        """Return whether any of the given indices may be targeted by the given path."""
+        cached_indices = self._get_indices(path)
+        return cached_indices is None or any(pattern_match(index, cached_index) or pattern_match(cached_index, index)
+                                             for index in indices for cached_index in cached_indices)
+
+
 class ElasticRequest(LoggingAware, object):
     """Base class for all Elasticsearch request handlers.
 
@@ -257,6 +429,29 @@ class ElasticRequest(LoggingAware, object):
     # implementation of is_valid() checks whether a request's path starts with this url
     base_url = None
 
+    # The number of seconds the response of Elasticsearch to a GET or HEAD request may be served from a cache.
+    # Since cached responses are shared between clients, this must only be set if inspect() rewrites the
+    # path and query so that they reflect what the client is permitted to access. (If necessary)
+    cache_ttl = None
+
+    # Whether a successful request alters metadata (e.g. mappings or aliases) which
+    # may be part of cached responses, in which case all cached responses are dropped
+    invalidates_cache = False
+
+    # Set this to True if the response of Elasticsearch consists of search results which may be served from the
+    # SearchResultCache. The same considerations as for cache_ttl apply, though the request's body is respected
+    result_cache = False
+
+    # Set this to True if Elasticsearch accepts a timeout= parameter which limits the time it spends on the request
+    # and responds with partial results once it expires. It is then injected to fit into the request's deadline
+    accepts_timeout = False
+
+    # The time at which Elasticsearch must have responded to the request, as set by set_deadline()
+    deadline = None
+
+    # Set to True once the client disconnected, which prevents the request from being sent to further nodes
+    abandoned = False
+
     # The locations grouped by commands a request handler is responsible for. Each key is a HTTP command such
     # as 'GET' and holds a single regular expression or a list of multiple regular expressions of type string.
     # Regular expressions may be automatically populated with certain macros. Please see the macros class
@@ -351,6 +546,23 @@ class ElasticRequest(LoggingAware, object):
 
         return json.dumps(data, indent=2, separators=(',', ' : '))
 
+    def expand_index_filter(self, index_filter):
+        """Return the given index filter expanded to the existing indices and aliases it matches.
+        Returns it unchanged if expansion is disabled or not possible or if the client controls
+        itself how wildcards are expanded and how unavailable indices are dealt with.
+
+        """
+        cluster_metadata = self.context.server.cluster_metadata
+        if cluster_metadata is not None and index_filter and not any(
+                param in self.query for param in ('expand_wildcards', 'ignore_unavailable')):
+            expansion = cluster_metadata.expand(index_filter)
+            if expansion is not None:
+                # The metadata may be outdated, indices removed in the meantime must not cause an error
+                self.query['ignore_unavailable'] = ['true']
+                return expansion
+
+        return index_filter
+
     def get_match(self, name, default=None):
         """Return the given group of the matched location or the default if no such group exists."""
         return self._match.groupdict().get(name, default)
@@ -375,6 +587,49 @@ class ElasticRequest(LoggingAware, object):
         self._match = match
         return True
 
+    def is_idempotent(self):
+        """Return whether identical requests which are forwarded at the same time may share a single response."""
+        if 'scroll' in self.query or self.path.startswith('/_search/scroll'):
+            return False  # Each of them would advance or open a separate scroll
+
+        return self.command in ('GET', 'HEAD') or self.result_cache
+
+    def set_deadline(self, client, default_timeout):
+        """Set the time at which Elasticsearch must have responded to this request. The time is based on the
+        timeout requested by the client or the given default, limited by the client's roles. Raises RequestError
+        if the requested timeout is invalid.
+
+        """
+        requested = self.query.last('timeout')
+        if requested is None and self.accepts_timeout and isinstance(self.json, dict):
+            requested = self.json.get('timeout')
+
+        timeout = default_timeout
+        if requested is not None:
+            try:
+                requested = parse_time_value(requested)
+            except (AttributeError, TypeError, ValueError):
+                raise RequestError(400, 'Invalid timeout "{0}".'.format(requested))
+
+            if requested > 0:  # Elasticsearch interprets negative timeouts as none
+                timeout = requested + DEADLINE_MARGIN
+
+        for role in client.roles:
+            if role.limits and role.limits.get('max_timeout') is not None:
+                try:
+                    # Parsed just like the timeouts of clients, so bare numbers are milliseconds
+                    max_timeout = parse_time_value(role.limits['max_timeout'])
+                except (AttributeError, TypeError, ValueError) as error:
+                    self.log.warning('Role "%s" defines an invalid timeout. An error occurred: %s', role.id, error)
+                else:
+                    timeout = min(timeout, max_timeout)
+
+        if self.accepts_timeout and (requested is None or requested <= 0 or requested + DEADLINE_MARGIN > timeout):
+            # Let Elasticsearch stop searching in time to respond with what it found so far
+            self.query['timeout'] = [format_time_value(max(timeout - DEADLINE_MARGIN, timeout / 2))]
+
+        self.deadline = time.time() + timeout
+
     def inspect(self, client):
         """Take a deeper look at the request and check if the given client may do
         what is requested. Raising a instance of RequestError here immediately
@@ -394,6 +649,10 @@ class ElasticRequest(LoggingAware, object):
         """
         pass
 
+    def transforms_payload(self):
+        """Return whether transform() is about to alter the payload of the response."""
+        return False
+
     def transform(self, stream, chunk_size):
         """Apply required transformations on the given response-body stream and return a new iterable."""
         return stream
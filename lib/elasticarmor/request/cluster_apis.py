@@ -5,6 +5,8 @@ from elasticarmor.util.elastic import FilterString
 
 
 class ClusterInfoApiRequest(ElasticRequest):
+    cache_ttl = 60  # Seconds
+
     def is_valid(self):
         return self.path == '/'
 
@@ -13,6 +15,7 @@ class ClusterInfoApiRequest(ElasticRequest):
 
 
 class ClusterHealthApiRequest(ElasticRequest):
+    cache_ttl = 2  # Seconds
     locations = {
         'GET': [
             '/_cluster/health',
@@ -21,6 +24,9 @@ class ClusterHealthApiRequest(ElasticRequest):
     }
 
     def inspect(self, client):
+        if any(param.startswith('wait_for_') for param in self.query):
+            self.cache_ttl = None  # Waiting for a specific state is pointless if the response is cached
+
         requested_indices = FilterString.from_string(self.get_match('indices', ''))
         index_filter = client.create_filter_string('api/cluster/health', requested_indices)
         if index_filter is None:
@@ -149,3 +155,19 @@ class NodesShutdownRequest(ElasticRequest):
     @Permissions('api/feature/deprecated', 'api/cluster/nodes/shutdown')
     def inspect(self, client):
         pass
+
+
+class QuotaStatsApiRequest(ElasticRequest):
+    locations = {
+        'GET': '/_elasticarmor/quotas'
+    }
+
+    @Permission('api/cluster/quotas')
+    def inspect(self, client):
+        response = ElasticResponse()
+        response.content = self.json_encode({'quotas': self.context.server.quota_manager.get_usage()},
+                                            not self.query.is_false('pretty'))
+        response.headers['Content-Length'] = str(len(response.content))
+        response.headers['Content-Type'] = 'application/json'
+        response.status_code = 200
+        return response
@@ -254,6 +254,9 @@ class MultiGetApiRequest(ElasticRequest):
         self.body = self.json_encode(self.json)
         self.query.discard('_source', '_source_include', '_source_exclude')
 
+    def transforms_payload(self):
+        return bool(self._errors)
+
     def transform(self, stream, chunk_size):
         if not self._errors:
             for chunk in stream:
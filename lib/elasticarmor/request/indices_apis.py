@@ -6,6 +6,7 @@ from elasticarmor.util.elastic import FilterString
 
 
 class CreateIndexApiRequest(ElasticRequest):
+    invalidates_cache = True
     locations = {
         'PUT': '/{index}',
         'POST': '/{index}'
@@ -39,6 +40,7 @@ class CreateIndexApiRequest(ElasticRequest):
 
 
 class DeleteIndexApiRequest(ElasticRequest):
+    invalidates_cache = True
     locations = {
         'DELETE': '/{indices}'
     }
@@ -49,6 +51,7 @@ class DeleteIndexApiRequest(ElasticRequest):
 
 
 class GetIndexApiRequest(ElasticRequest):
+    cache_ttl = 10  # Seconds
     locations = {
         'HEAD': '/{indices}',
         'GET': [
@@ -77,14 +80,14 @@ class GetIndexApiRequest(ElasticRequest):
             if unknown is not None:
                 raise PermissionError('Unknown index setting: {0}'.format(unknown))
 
+            contexts = [(index, None, None) for index in index_filter.iter_patterns()]
             permitted_settings, missing_permissions = [], {}
             for setting, permission in self.index_settings.iteritems():
                 if not keywords or setting in keywords:
-                    for index in index_filter.iter_patterns():
-                        if client.can(permission, index):
-                            permitted_settings.append(setting)
-                        elif setting in keywords:
-                            missing_permissions.setdefault(permission, []).append(str(index))
+                    forbidden = client.forbidden(permission, contexts)
+                    permitted_settings.extend([setting] * (len(contexts) - len(forbidden)))
+                    if forbidden and setting in keywords:
+                        missing_permissions[permission] = [str(index) for index, _, _ in forbidden]
 
             if missing_permissions:
                 permission_hint = ', '.join('{0} ({1})'.format(permission, ', '.join(indices))
@@ -95,6 +98,7 @@ class GetIndexApiRequest(ElasticRequest):
 
 
 class OpenIndexApiRequest(ElasticRequest):
+    invalidates_cache = True
     locations = {
         'POST': '/{indices}/_open'
     }
@@ -105,6 +109,7 @@ class OpenIndexApiRequest(ElasticRequest):
 
 
 class CloseIndexApiRequest(ElasticRequest):
+    invalidates_cache = True
     locations = {
         'POST': '/{indices}/_close'
     }
@@ -115,6 +120,7 @@ class CloseIndexApiRequest(ElasticRequest):
 
 
 class CreateMappingApiRequest(ElasticRequest):
+    invalidates_cache = True
     locations = {
         'PUT': [
             '/_mapping{s}/{document}',
@@ -147,6 +153,7 @@ class CreateMappingApiRequest(ElasticRequest):
 
 
 class GetMappingApiRequest(ElasticRequest):
+    cache_ttl = 10  # Seconds
     before = 'GetIndexApiRequest'
 
     locations = {
@@ -193,6 +200,7 @@ class GetMappingApiRequest(ElasticRequest):
 
 
 class GetFieldMappingApiRequest(ElasticRequest):
+    cache_ttl = 10  # Seconds
     locations = {
         'GET': [
             '/{indices}/_mapping/field/{fields}',
@@ -231,6 +239,7 @@ class GetFieldMappingApiRequest(ElasticRequest):
 
 
 class DeleteMappingApiRequest(ElasticRequest):
+    invalidates_cache = True
     before = 'DeleteApiRequest'
     locations = {
         'DELETE': [
@@ -246,6 +255,7 @@ class DeleteMappingApiRequest(ElasticRequest):
 
 
 class CreateAliasApiRequest(ElasticRequest):
+    invalidates_cache = True
     locations = {
         'POST': '/_aliases',
         'PUT': '/{indices}/_alias{es}/{name}'
@@ -257,6 +267,7 @@ class CreateAliasApiRequest(ElasticRequest):
 
 
 class DeleteAliasApiRequest(ElasticRequest):
+    invalidates_cache = True
     locations = {
         'DELETE': '/{indices}/_alias{es}/{names}'
     }
@@ -267,6 +278,7 @@ class DeleteAliasApiRequest(ElasticRequest):
 
 
 class GetAliasApiRequest(ElasticRequest):
+    cache_ttl = 10  # Seconds
     before = 'GetIndexApiRequest'
     locations = {
         'GET': [
@@ -291,6 +303,7 @@ class GetAliasApiRequest(ElasticRequest):
 
 
 class UpdateIndexSettingsApiRequest(ElasticRequest):
+    invalidates_cache = True
     locations = {
         'PUT': [
             '/_settings',
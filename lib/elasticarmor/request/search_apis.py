@@ -6,7 +6,7 @@ from StringIO import StringIO
 from elasticarmor import APP_NAME
 from elasticarmor.auth import MultipleIncludesError
 from elasticarmor.request import *
-from elasticarmor.util.elastic import (SourceFilter, FilterString, QueryDslParser, AggregationParser,
+from elasticarmor.util.elastic import (SourceFilter, FilterString, QueryCost, QueryDslParser, AggregationParser,
                                        HighlightParser, FieldsFilter)
 
 
@@ -30,6 +30,20 @@ class SearchApiRequest(ElasticRequest):
         ]
     }
 
+    result_cache = True
+    accepts_timeout = True
+
+    # Maps the names of caps which may be defined by roles to the sizes they clamp and, if these
+    # are parameters of the request itself, to the values Elasticsearch assumes in their absence
+    caps = [
+        ('clamp_size', 'size', 10),
+        ('clamp_from', 'from', 0),
+        ('clamp_aggregation_size', 'aggregation size', None),
+        ('clamp_top_hits_size', 'top_hits size', None)
+    ]
+
+    _clamped = None
+
     _permission_errors = {
         'api/search/explain': {
             'cluster': 'You are not permitted to access scoring explanations.',
@@ -102,6 +116,7 @@ class SearchApiRequest(ElasticRequest):
             self.query.update(fields_filter.as_query())
 
         if index_filter:
+            index_filter = self.expand_index_filter(index_filter)
             if type_filter:
                 self.path = '/{0}/{1}/_search'.format(index_filter, type_filter)
             else:
@@ -216,11 +231,16 @@ class SearchApiRequest(ElasticRequest):
         else:
             source_filter = requested_source
 
+        if self._clamp_request(client, json):
+            json_updated = True
+
+        cost = QueryCost()
         if json is not None:
             if json.get('query'):
                 query = QueryDslParser()
                 query.query(json['query'])
                 self._inspect_parser(client, query, index_filter, type_filter)
+                cost.update(query.cost)
 
             aggregation_keyword = next((k for k in reversed(json) if k in ['aggregations', 'aggs']), None)
             if aggregation_keyword is not None and json.get(aggregation_keyword):
@@ -228,6 +248,7 @@ class SearchApiRequest(ElasticRequest):
                 aggregations.aggregations(json[aggregation_keyword])
                 if self._inspect_parser(client, aggregations, index_filter, type_filter):
                     json_updated = True
+                cost.update(aggregations.cost)
 
             if json.get('highlight'):
                 highlight = HighlightParser()
@@ -238,6 +259,7 @@ class SearchApiRequest(ElasticRequest):
                 post_filter = QueryDslParser()
                 post_filter.filter(json['post_filter'])
                 self._inspect_parser(client, post_filter, index_filter, type_filter)
+                cost.update(post_filter.cost)
 
             if json.get('rescore'):
                 try:
@@ -249,23 +271,153 @@ class SearchApiRequest(ElasticRequest):
                     query = QueryDslParser()
                     query.query(rescore['rescore_query'])
                     self._inspect_parser(client, query, index_filter, type_filter)
+                    cost.update(query.cost)
+
+            if json.get('script_fields'):
+                cost.scripts += len(json['script_fields'])
 
+        cost.result_window = self._get_result_window(json)
+        self._check_cost(client, cost)
         return index_filter, type_filter, source_filter, json if json_updated else None
 
+    def _get_caps(self, client):
+        """Return the smallest of each cap defined by the roles of the given client."""
+        caps = {}
+        for role in client.roles:
+            if role.limits:
+                for cap_name, _, _ in self.caps:
+                    try:
+                        cap = role.limits.get(cap_name)
+                        if cap is not None:
+                            caps[cap_name] = min(int(cap), caps.get(cap_name, int(cap)))
+                    except (AttributeError, TypeError, ValueError) as error:
+                        self.log.warning('Role "%s" defines an invalid cap. An error occurred: %s', role.id, error)
+
+        return caps
+
+    def _clamp_request(self, client, json):
+        """Clamp the sizes the given search request asks for to the caps defined by the given client's roles.
+        Returns whether the given JSON body has been updated.
+
+        """
+        caps = self._get_caps(client)
+        if not caps:
+            return False
+
+        clamped, json_updated = set(), False
+        for cap_name, parameter, default in self.caps:
+            cap = caps.get(cap_name)
+            if cap is None or default is None:
+                continue
+
+            if parameter in self.query:
+                # Parameters in the query take precedence over the ones in the body
+                if self._exceeds(self.query.last(parameter), cap):
+                    self.query[parameter] = [str(cap)]
+                    clamped.add(parameter)
+            elif json is not None:
+                if self._exceeds(json.get(parameter, default), cap):
+                    json[parameter] = cap
+                    clamped.add(parameter)
+                    json_updated = True
+            elif default > cap:
+                self.query[parameter] = [str(cap)]
+                clamped.add(parameter)
+
+        aggregation_keyword = next((k for k in reversed(json) if k in ['aggregations', 'aggs']), None) \
+            if json is not None else None
+        if aggregation_keyword is not None and isinstance(json[aggregation_keyword], dict):
+            if self._clamp_aggregations(json[aggregation_keyword], caps, clamped):
+                json_updated = True
+
+        if clamped:
+            self._clamped = (self._clamped or set()) | clamped
+        return json_updated
+
+    def _clamp_aggregations(self, aggregations, caps, clamped):
+        """Clamp the sizes the given aggregations ask for to the given caps and add
+        the names of the clamped sizes to the given set. Returns whether any were.
+
+        """
+        updated = False
+        for agg_body in aggregations.itervalues():
+            if not isinstance(agg_body, dict):
+                continue  # Let the parser complain about it
+
+            for agg_name, agg_obj in agg_body.iteritems():
+                if not isinstance(agg_obj, dict):
+                    continue
+                elif agg_name in ('aggs', 'aggregations'):
+                    if self._clamp_aggregations(agg_obj, caps, clamped):
+                        updated = True
+                elif agg_name in ('terms', 'significant_terms', 'geohash_grid'):
+                    cap = caps.get('clamp_aggregation_size')
+                    if cap is not None:
+                        for parameter, default in (('size', 10000 if agg_name == 'geohash_grid' else 10),
+                                                   ('shard_size', None)):
+                            value = agg_obj.get(parameter, default)
+                            if value is not None and self._exceeds(value, cap, zero_is_unbounded=True):
+                                agg_obj[parameter] = cap
+                                clamped.add('aggregation size')
+                                updated = True
+                elif agg_name == 'top_hits':
+                    cap = caps.get('clamp_top_hits_size')
+                    if cap is not None and self._exceeds(agg_obj.get('size', 3), cap):
+                        agg_obj['size'] = cap
+                        clamped.add('top_hits size')
+                        updated = True
+
+        return updated
+
+    @staticmethod
+    def _exceeds(value, cap, zero_is_unbounded=False):
+        """Return whether the given size exceeds the given cap."""
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return False  # Elasticsearch will complain about it
+
+        return value > cap or zero_is_unbounded and value == 0
+
+    def prepare_transformation(self, response):
+        if self._clamped and response.status_code == 200:
+            return 'Clamped the requested {0} to the maximum permitted by your roles.'.format(
+                ', '.join(name for _, name, _ in self.caps if name in self._clamped))
+
+    def _get_result_window(self, json):
+        """Return the number of hits up to which the given search request asks for."""
+        if self.query.last('search_type') == 'count':
+            return 0
+
+        try:
+            size = int(self.query.last('size', json.get('size', 10) if json is not None else 10))
+            offset = int(self.query.last('from', json.get('from', 0) if json is not None else 0))
+        except (TypeError, ValueError):
+            return 0  # Elasticsearch will complain about it
+
+        return offset + size
+
+    def _check_cost(self, client, cost):
+        """Raise PermissionError in case the given cost exceeds the budget of any of the given client's roles."""
+        for role in client.roles:
+            if role.limits:
+                try:
+                    exceeded = cost.exceeds(role.limits)
+                except (AttributeError, TypeError, ValueError) as error:
+                    self.log.warning('Role "%s" defines invalid budgets. An error occurred: %s', role.id, error)
+                else:
+                    if exceeded:
+                        raise PermissionError('Role "{0}" does not permit search requests'
+                                              ' exceeding {1}.'.format(role.id, exceeded))
+
     def _check_permission(self, permission, client, index_filter, type_filter=None, fields=None):
         if index_filter:
-            forbidden = []
-            for index in index_filter.iter_patterns():
-                if type_filter:
-                    for document_type in type_filter.iter_patterns():
-                        if fields:
-                            for field in fields:
-                                if not client.can(permission, index, document_type, field):
-                                    forbidden.append('/'.join((str(index), str(document_type), str(field))))
-                        elif not client.can(permission, index, document_type):
-                            forbidden.append('/'.join((str(index), str(document_type))))
-                elif not client.can(permission, index):
-                    forbidden.append(str(index))
+            contexts = [(index, document_type, field)
+                        for index in index_filter.iter_patterns()
+                        for document_type in (type_filter.iter_patterns() if type_filter else [None])
+                        for field in (fields if type_filter and fields else [None])]
+            forbidden = ['/'.join(str(part) for part in context if part is not None)
+                         for context in client.forbidden(permission, contexts)]
 
             if forbidden:
                 scope = 'fields' if fields else 'types' if type_filter else 'indices'
@@ -407,6 +559,7 @@ class SuggestApiRequest(ElasticRequest):
 
 
 class MultiSearchApiRequest(SearchApiRequest):
+    accepts_timeout = False  # Only the individual searches do
     _errors = None
 
     before = [
@@ -460,6 +613,9 @@ class MultiSearchApiRequest(SearchApiRequest):
         self.path = '/_msearch'  # We're enforcing headers with indices and types where applicable
         self.body = '\n'.join(lines) + '\n'
 
+    def transforms_payload(self):
+        return bool(self._errors)
+
     def transform(self, stream, chunk_size):
         if not self._errors:
             return stream
@@ -536,6 +692,8 @@ class MultiSearchApiRequest(SearchApiRequest):
 
 
 class CountApiRequest(SearchApiRequest):
+    accepts_timeout = False
+
     before = [
         'GetIndexApiRequest',
         'IndexApiRequest',
@@ -555,6 +713,12 @@ class CountApiRequest(SearchApiRequest):
         ]
     }
 
+    def _clamp_request(self, client, json):
+        return False  # Counts do not support any sizes
+
+    def _get_result_window(self, json):
+        return 0  # Counts do not return any hits
+
     def inspect(self, client):
         index_filter, type_filter, _, json = self.inspect_request(
             client, FilterString.from_string(self.get_match('indices', '')),
@@ -567,6 +731,7 @@ class CountApiRequest(SearchApiRequest):
                     'You are restricted to specific fields and as such cannot utilize the query string search.')
 
         if index_filter:
+            index_filter = self.expand_index_filter(index_filter)
             if type_filter:
                 self.path = '/{0}/{1}/_count'.format(index_filter, type_filter)
             else:
@@ -597,6 +762,8 @@ class SearchExistsApiRequest(ElasticRequest):
 
 
 class ValidateApiRequest(SearchApiRequest):
+    accepts_timeout = False
+
     locations = {
         'GET': [
             '/_validate/query',
@@ -611,6 +778,12 @@ class ValidateApiRequest(SearchApiRequest):
         ]
     }
 
+    def _clamp_request(self, client, json):
+        return False  # Queries are only validated, not executed
+
+    def _check_cost(self, client, cost):
+        pass  # Queries are only validated, not executed
+
     def inspect(self, client):
         if '__kibanaQueryValidator' in self.path:
             # I have _still_ no explanation for this. Please enlighten
@@ -634,6 +807,7 @@ class ValidateApiRequest(SearchApiRequest):
             self._check_permission('api/search/explain', client, index_filter, type_filter)
 
         if index_filter:
+            index_filter = self.expand_index_filter(index_filter)
             if type_filter:
                 self.path = '/{0}/{1}/_validate/query'.format(index_filter, type_filter)
             else:
@@ -7,20 +7,28 @@ import os.path
 import socket
 import sys
 from logging.handlers import SysLogHandler
+from multiprocessing.pool import ThreadPool
 
 import requests
 
 from elasticarmor import *
-from elasticarmor.auth.elasticsearch_backend import ElasticsearchRoleBackend, ElasticsearchUserBackend
+from elasticarmor.auth.elasticsearch_backend import ElasticsearchRoleBackend, ElasticsearchUserBackend, \
+    ConfigurationWatcher
 from elasticarmor.auth.ldap_backend import LdapUserBackend, LdapUsergroupBackend
 from elasticarmor.util import format_elasticsearch_error, compare_major_and_minor_version, cachedproperty
+from elasticarmor.util.admission import AdmissionController
+from elasticarmor.util.compression import ResponseCompressor
 from elasticarmor.util.config import Parser
 from elasticarmor.util.daemon import Settings
-from elasticarmor.util.elastic import ElasticConnection
+from elasticarmor.request import ResponseCache, SearchResultCache
+from elasticarmor.util.elastic import SNIFF_NODE_TYPES, ElasticConnection, ClusterMetadata, NodeSniffer
+from elasticarmor.util.hedging import HedgingPolicy
 from elasticarmor.util.mixins import LoggingAware
 
 __all__ = ['ElasticSettings']
 
+NODE_PROBE_TIMEOUT = 5  # Seconds
+
 
 class ElasticSettings(LoggingAware, Settings):
     default_configuration = {
@@ -32,7 +40,27 @@ class ElasticSettings(LoggingAware, Settings):
         'elasticsearch': DEFAULT_NODE,
         'address': DEFAULT_ADDRESS,
         'port': DEFAULT_PORT,
-        'secured': 'false'
+        'secured': 'false',
+        'snapshot': DEFAULT_SNAPSHOT_FILE,
+        'expand_index_patterns': 'false',
+        'response_cache_size': '1000',
+        'search_cache_size': '0',
+        'search_cache_ttl': '10',
+        'search_cache_index_ttls': '',
+        'concurrency_limit': '0',
+        'queue_size': '200',
+        'queue_timeout': '5',
+        'adaptive_concurrency_limit': 'false',
+        'request_timeout': '10',
+        'hedge_requests': 'false',
+        'hedge_percentile': '95',
+        'hedge_budget': '5',
+        'sniff_interval': '0',
+        'sniff_node_type': 'all',
+        'sniff_attributes': '',
+        'compress_responses': 'false',
+        'compression_min_size': '1024',
+        'compression_types': 'application/json,application/yaml,text/plain'
     }
 
     default_authentication_config = {
@@ -197,6 +225,67 @@ class ElasticSettings(LoggingAware, Settings):
         self._check_file_permissions(certificate_path, 'r')
         return certificate_path
 
+    @property
+    def snapshot_file(self):
+        file_path = self.config.get('proxy', 'snapshot').strip()
+        if file_path:
+            return os.path.realpath(file_path)
+
+    @property
+    def expand_index_patterns(self):
+        return self.config.getboolean('proxy', 'expand_index_patterns')
+
+    @property
+    def response_cache(self):
+        size = self.config.getint('proxy', 'response_cache_size')
+        if size > 0:
+            return ResponseCache(size)
+
+    @property
+    def search_result_cache(self):
+        size = self.config.getint('proxy', 'search_cache_size')
+        if size > 0:
+            index_ttls = []
+            for pattern_and_ttl in self.config.get('proxy', 'search_cache_index_ttls').split(','):
+                if pattern_and_ttl.strip():
+                    try:
+                        pattern, ttl = pattern_and_ttl.rsplit(':', 1)
+                        index_ttls.append((pattern.strip(), int(ttl)))
+                    except ValueError:
+                        self._exit('Invalid index TTL "%s" in option "search_cache_index_ttls"', pattern_and_ttl)
+
+            return SearchResultCache(size * 2**20, self.config.getint('proxy', 'search_cache_ttl'), index_ttls)
+
+    @property
+    def admission_controller(self):
+        limit = self.config.getint('proxy', 'concurrency_limit')
+        if limit > 0:
+            return AdmissionController(limit, self.config.getint('proxy', 'queue_size'),
+                                       self.config.getfloat('proxy', 'queue_timeout'),
+                                       self.config.getboolean('proxy', 'adaptive_concurrency_limit'))
+
+    @property
+    def request_timeout(self):
+        timeout = self.config.getfloat('proxy', 'request_timeout')
+        if timeout <= 0:
+            self._exit('Option "request_timeout" must be greater than zero')
+        return timeout
+
+    @property
+    def hedging_policy(self):
+        if self.config.getboolean('proxy', 'hedge_requests'):
+            percentile = self.config.getfloat('proxy', 'hedge_percentile')
+            if not 0 < percentile < 100:
+                self._exit('Option "hedge_percentile" must be greater than 0 and less than 100')
+
+            return HedgingPolicy(percentile, self.config.getfloat('proxy', 'hedge_budget'))
+
+    @property
+    def response_compressor(self):
+        if self.config.getboolean('proxy', 'compress_responses'):
+            content_types = [t.strip() for t in self.config.get('proxy', 'compression_types').split(',') if t.strip()]
+            return ResponseCompressor(self.config.getint('proxy', 'compression_min_size'), content_types)
+
     @property
     def allow_from(self):
         try:
@@ -244,12 +333,16 @@ class ElasticSettings(LoggingAware, Settings):
     @cachedproperty
     def elasticsearch(self):
         nodes = self.elasticsearch_nodes
-        for node in nodes:
-            try:
-                response = requests.get(node)
-                response.raise_for_status()
-            except requests.RequestException as error:
-                self.log.warning('Node "%s" is not reachable. Error: %s', node, format_elasticsearch_error(error))
+        pool = ThreadPool(len(nodes))
+        try:
+            responses = pool.map(self._probe_node, nodes)
+        finally:
+            pool.close()
+            pool.join()
+
+        for node, response in zip(nodes, responses):
+            if isinstance(response, requests.RequestException):
+                self.log.warning('Node "%s" is not reachable. Error: %s', node, format_elasticsearch_error(response))
             else:
                 try:
                     result = response.json()
@@ -268,7 +361,17 @@ class ElasticSettings(LoggingAware, Settings):
                                      ' by sending us the results of a test ran against this particular node.',
                                      node, node_version)"""
 
-        return ElasticConnection(nodes)
+        return ElasticConnection(nodes, self.hedging_policy, round_robin=self.sniff_interval > 0)
+
+    def _probe_node(self, node):
+        """Send a request to the given node and return the response or the error which occurred."""
+        try:
+            response = requests.get(node, timeout=NODE_PROBE_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as error:
+            return error
+        else:
+            return response
 
     @property
     def elasticsearch_nodes(self):
@@ -291,6 +394,38 @@ class ElasticSettings(LoggingAware, Settings):
     def role_backend(self):
         return ElasticsearchRoleBackend(self)
 
+    @property
+    def configuration_watcher(self):
+        return ConfigurationWatcher(self.elasticsearch)
+
+    @property
+    def cluster_metadata(self):
+        if self.expand_index_patterns:
+            return ClusterMetadata(self.elasticsearch)
+
+    @property
+    def sniff_interval(self):
+        return self.config.getint('proxy', 'sniff_interval')
+
+    @property
+    def node_sniffer(self):
+        if self.sniff_interval > 0:
+            node_type = self.config.get('proxy', 'sniff_node_type')
+            if node_type not in SNIFF_NODE_TYPES:
+                self._exit('Invalid node type "%s" set. Valid node types are: %s',
+                           node_type, ', '.join(SNIFF_NODE_TYPES))
+
+            attributes = {}
+            for name_and_value in self.config.get('proxy', 'sniff_attributes').split(','):
+                if name_and_value.strip():
+                    try:
+                        name, value = name_and_value.split(':', 1)
+                        attributes[name.strip()] = value.strip()
+                    except ValueError:
+                        self._exit('Invalid attribute "%s" in option "sniff_attributes"', name_and_value)
+
+            return NodeSniffer(self.elasticsearch, self.sniff_interval, node_type, attributes)
+
     @property
     def auth_backends(self):
         backends = []
@@ -323,6 +458,7 @@ class ElasticSettings(LoggingAware, Settings):
             # TODO: Can't help myself, but passing self AND get_option seems a bit overkill to me..
             backend = backend_type(section_name, get_option, self)
             backend.default_role = self.authentication.get(section_name, 'default_role')
+            backend.timeout = self._get_backend_timeout(self.authentication, section_name, backend.timeout)
             backends.append(backend)
 
         return backends
@@ -353,10 +489,25 @@ class ElasticSettings(LoggingAware, Settings):
                         self._exit('Missing "%s" option in group backend "%s".', option_name, section_name)
 
             # TODO: Can't help myself, but passing self AND get_option seems a bit overkill to me..
-            backends.append(backend_type(section_name, get_option, self))
+            backend = backend_type(section_name, get_option, self)
+            backend.timeout = self._get_backend_timeout(self.groups, section_name, backend.timeout)
+            backends.append(backend)
 
         return backends
 
+    def _get_backend_timeout(self, parser, section_name, default):
+        """Return the timeout configured for the given backend or the given default if there is none."""
+        try:
+            timeout = parser.getfloat(section_name, 'timeout')
+        except ConfigParser.NoOptionError:
+            return default
+        except ValueError:
+            self._exit('Invalid timeout set for backend "%s".', section_name)
+
+        if timeout <= 0:
+            self._exit('The timeout of backend "%s" must be greater than zero.', section_name)
+        return timeout
+
     def _check_file_permissions(self, path, open_mode, suppress_errors=False):
         remove = open_mode[0] == 'w' or (open_mode != 'r' and not os.path.isfile(path))
 
@@ -4,9 +4,12 @@ import re
 from distutils.version import StrictVersion
 
 __all__ = ['format_ldap_error', 'format_elasticsearch_error', 'compare_major_and_minor_version',
-           'pattern_match', 'pattern_compare', 'classproperty', 'cachedproperty', 'strip_quotes']
+           'pattern_match', 'pattern_compare', 'classproperty', 'cachedproperty', 'strip_quotes',
+           'parse_time_value', 'format_time_value']
 
 CACHE_MAX_SIZE = 1000
+TIME_UNITS = [('nanos', 1e-9), ('micros', 1e-6), ('ms', 1e-3), ('s', 1), ('m', 60), ('h', 3600), ('d', 86400),
+              ('w', 604800)]
 _pattern_cache = {}
 
 
@@ -207,3 +210,25 @@ def strip_quotes(buf):
         raise TypeError('Expected type string, got %s instead' % type(buf))
 
     return buf
+
+
+def parse_time_value(value):
+    """Parse the given time value as understood by Elasticsearch (e.g. "500ms" or "1m") and return
+    the number of seconds it represents. Values without unit are milliseconds. Raises ValueError
+    if the given value is not a valid time value.
+
+    """
+    if isinstance(value, (int, long, float)):
+        return value / 1000.0
+
+    value = value.strip().lower()
+    for unit, seconds in TIME_UNITS:
+        if value.endswith(unit):  # Units ending with another one are listed first, so "ms" is not taken for "s"
+            return float(value[:-len(unit)]) * seconds
+
+    return float(value) / 1000.0
+
+
+def format_time_value(seconds):
+    """Return the given number of seconds as time value understood by Elasticsearch."""
+    return '{0}ms'.format(int(seconds * 1000))
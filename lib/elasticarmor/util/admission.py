@@ -0,0 +1,102 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import math
+import threading
+import time
+
+from elasticarmor.util.mixins import LoggingAware
+
+__all__ = ['AdmissionController']
+
+ADAPTIVE_MIN_LIMIT = 4  # Requests
+ADAPTIVE_SMOOTHING = 0.2
+ADAPTIVE_TOLERANCE = 1.5  # How much the latency may rise before the limit is lowered
+SHORT_LATENCY_WEIGHT = 0.1  # Roughly the last 10 requests
+LONG_LATENCY_WEIGHT = 0.002  # Roughly the last 500 requests
+
+
+class AdmissionController(LoggingAware, object):
+    """Limits the number of requests which are processed at the same time.
+
+    Requests exceeding the limit wait in a bounded queue for at most the given number of seconds. If the
+    queue is full or the time is up, they are refused. If adaptive is True, the limit is lowered down to
+    a minimum once the observed latency of Elasticsearch rises and raised again once it recovers.
+    """
+
+    def __init__(self, limit, queue_size, queue_timeout, adaptive=False):
+        self.max_limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.adaptive = adaptive
+
+        self.limit = float(limit)
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+        self._short_latency = None
+        self._long_latency = None
+
+    def acquire(self):
+        """Wait until a request may be processed and return True, or False if it has to be refused."""
+        with self._condition:
+            if self.active < int(self.limit) and not self.waiting:
+                self.active += 1
+                return True
+            elif self.waiting >= self.queue_size:
+                return False
+
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.queue_timeout
+                while self.active >= int(self.limit):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+
+                    self._condition.wait(remaining)
+
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+                if self.waiting and self.active < int(self.limit):
+                    self._condition.notify()  # Pass on a wakeup we did not need or could not use anymore
+
+    def release(self):
+        """Release a request which has been admitted earlier."""
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def observe(self, latency):
+        """Register the given latency of Elasticsearch and adjust the limit, if adaptive."""
+        if not self.adaptive:
+            return
+
+        with self._condition:
+            if self._short_latency is None:
+                self._short_latency = self._long_latency = latency
+                return
+
+            self._short_latency += (latency - self._short_latency) * SHORT_LATENCY_WEIGHT
+            self._long_latency += (latency - self._long_latency) * LONG_LATENCY_WEIGHT
+            if self._long_latency > 2 * self._short_latency:
+                # The latency recovered from a sustained rise, so let the long-term average catch up faster
+                self._long_latency *= 0.95
+
+            if self._short_latency > 0:
+                gradient = max(0.5, min(1.0, ADAPTIVE_TOLERANCE * self._long_latency / self._short_latency))
+            else:
+                gradient = 1.0
+
+            new_limit = self.limit * gradient + math.sqrt(self.limit)
+            new_limit = self.limit * (1 - ADAPTIVE_SMOOTHING) + new_limit * ADAPTIVE_SMOOTHING
+            new_limit = min(self.max_limit, max(ADAPTIVE_MIN_LIMIT, new_limit))
+            if int(new_limit) != int(self.limit):
+                self.log.debug('Adjusting concurrency limit from %u to %u. (Latency: %.3fs, long-term: %.3fs)',
+                               self.limit, new_limit, self._short_latency, self._long_latency)
+            if int(new_limit) > int(self.limit):
+                self._condition.notify(int(new_limit) - int(self.limit))  # Wake up requests which may now proceed
+
+            self.limit = new_limit
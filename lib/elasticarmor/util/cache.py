@@ -0,0 +1,103 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import threading
+import time
+
+try:
+    # Python 2.7+
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from simplejson import OrderedDict
+
+__all__ = ['Cache']
+
+
+class Cache(object):
+    """Thread-safe key-value cache with an optional size limit and time-to-live.
+
+    Once the size limit is reached, the least recently used entry is evicted. Entries
+    older than the time-to-live are considered missing and are removed on access. By
+    default each entry counts as one towards the size limit, pass a function to
+    sizeof to weigh values differently (e.g. by the number of bytes they occupy).
+    """
+
+    def __init__(self, max_size=None, ttl=None, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof
+
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        """Return the value of the given key or the default if it is not cached or has expired."""
+        with self._lock:
+            try:
+                value, expires, size = self._entries.pop(key)
+            except KeyError:
+                return default
+
+            if expires is not None and expires <= time.time():
+                self.size -= size
+                return default
+
+            self._entries[key] = value, expires, size  # Re-inserting the entry marks it as the most recently used
+            return value
+
+    def items(self):
+        """Return a list of all key-value pairs which have not expired yet, least recently used first."""
+        now = time.time()
+        with self._lock:
+            return [(key, value) for key, (value, expires, _) in self._entries.iteritems()
+                    if expires is None or expires > now]
+
+    def values(self):
+        """Return a list of all values which have not expired yet, least recently used first."""
+        return [value for _, value in self.items()]
+
+    def set(self, key, value, ttl=None):
+        """Cache the given value under the given key. The given time-to-live overrides the default."""
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        size = self.sizeof(value) if self.sizeof is not None else 1
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = value, expires, size
+            self.size += size
+            if self.max_size is not None:
+                while self.size > self.max_size:
+                    self.size -= self._entries.popitem(last=False)[1][2]
+
+    def discard(self, *keys):
+        """Remove the given keys from this cache, if present."""
+        with self._lock:
+            for key in keys:
+                self._pop(key)
+
+    def discard_if(self, predicate):
+        """Remove all entries for which the given predicate returns True when called with their key and value."""
+        with self._lock:
+            for key in [k for k, (v, _, _) in self._entries.iteritems() if predicate(k, v)]:
+                self._pop(key)
+
+    def clear(self):
+        """Remove all entries from this cache."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        """Remove the given key from this cache, if present. Must be called while holding the lock."""
+        try:
+            self.size -= self._entries.pop(key)[2]
+        except KeyError:
+            pass
@@ -0,0 +1,79 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import zlib
+
+from elasticarmor.util.mixins import LoggingAware
+
+__all__ = ['ResponseCompressor']
+
+COMPRESSION_LEVEL = 6  # Between 1 (fastest) and 9 (smallest)
+COMPRESSION_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS  # As required by RFC 7230, this is the zlib format and not raw deflate
+}
+
+
+class ResponseCompressor(LoggingAware, object):
+    """Compresses response payloads using a content coding the client accepts.
+
+    Only payloads of the given content types, which are not encoded already and of which
+    the size is either unknown or at least the given minimum, are compressed.
+    """
+
+    def __init__(self, min_size, content_types):
+        self.min_size = min_size
+        self.content_types = frozenset(t.lower() for t in content_types)
+
+    def negotiate(self, accept_encoding):
+        """Return the preferred content coding of the given Accept-Encoding header or None if there is none."""
+        if not accept_encoding:
+            return
+
+        qualities = {}
+        for coding in accept_encoding.split(','):
+            name, _, params = coding.partition(';')
+            quality = 1.0
+            for param in params.split(';'):
+                key, _, value = param.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+
+            qualities[name.strip().lower()] = quality
+
+        wildcard = qualities.get('*', 0.0)
+        best = max(COMPRESSION_WBITS, key=lambda c: (qualities.get(c, wildcard), c == 'gzip'))
+        if qualities.get(best, wildcard) > 0:
+            return best
+
+    def is_compressible(self, response):
+        """Return whether the payload of the given response should be compressed."""
+        if response.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            return False  # Elasticsearch compressed it already
+
+        content_type = response.headers.get('Content-Type', '').split(';', 1)[0].strip().lower()
+        if content_type not in self.content_types:
+            return False
+
+        try:
+            return int(response.headers['Content-Length']) >= self.min_size
+        except (KeyError, ValueError):
+            return True  # Chunked payloads are most likely large ones
+
+    def compress(self, stream, coding):
+        """Return a generator compressing the chunks of the given stream using the given content coding."""
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, COMPRESSION_WBITS[coding])
+        try:
+            for chunk in stream:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+
+            yield compressor.flush()
+        finally:
+            try:
+                stream.close()
+            except AttributeError:
+                pass
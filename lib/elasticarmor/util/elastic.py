@@ -1,33 +1,73 @@
 # ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
 
+import Queue
 import base64
+import io
+import itertools
+import json
+import socket
+import sys
 import time
 import urllib
+import urlparse
 import threading
 
 import requests
+from requests.packages.urllib3.response import HTTPResponse
+from requests.structures import CaseInsensitiveDict
 
 from elasticarmor import *
 from elasticarmor.util import format_elasticsearch_error, pattern_compare
+from elasticarmor.util.cache import Cache
 from elasticarmor.util.http import Query
 from elasticarmor.util.rwlock import ReadWriteLock
 from elasticarmor.util.mixins import LoggingAware
 
-__all__ = ['ElasticSearchError', 'ElasticConnection', 'ElasticObject', 'ElasticRole', 'QueryDslParser',
+__all__ = ['ElasticSearchError', 'ElasticConnection', 'ClusterMetadata', 'NodeSniffer', 'ElasticObject', 'ElasticRole',
+           'ElasticRoleMembership', 'QueryCost', 'QueryDslParser',
            'AggregationParser', 'HighlightParser', 'SourceFilter', 'FilterString', 'FieldsFilter']
 
 DEFAULT_TIMEOUT = 10  # Seconds
 CHECK_REACHABILITY_INTERVAL = 900  # Seconds
+SCROLL_PAGE_SIZE = 500  # Documents per page
+SCROLL_KEEP_ALIVE = '1m'
+METADATA_REFRESH_INTERVAL = 30  # Seconds
+METADATA_TTL = 90  # Seconds
+SNIFF_NODE_TYPES = ('all', 'client', 'data')
+METADATA_EXPANSION_CACHE_SIZE = 1000
+METADATA_EXPANSION_LIMIT = 2048  # Characters
+FILTER_STRING_INDEX_THRESHOLD = 8  # Parts
+COALESCING_BUFFER_LIMIT = 2**22  # Bytes, 4MiB
+COALESCING_CHECK_INTERVAL = 0.5  # Seconds, how often a waiting request checks whether it has been abandoned
+UNBOUNDED_SIZE = 2**31 - 1  # What a size of zero means to Elasticsearch 1.x
 
 
 class ElasticSearchError(Exception):
     pass
 
 
+class _Flight(object):
+    """A request which is currently being processed on behalf of one or more identical requests."""
+
+    __slots__ = ('landed', 'shared', 'response', 'error')
+
+    def __init__(self):
+        self.landed = threading.Event()
+        self.shared = False
+        self.response = None
+        self.error = None
+
+
 class ElasticConnection(LoggingAware, object):
     """Class for failover handling of multiple Elasticsearch nodes."""
-    def __init__(self, nodes):
+    def __init__(self, nodes, hedging_policy=None, round_robin=False):
         self.nodes = set(nodes)
+        self.hedging_policy = hedging_policy
+        self.round_robin = round_robin
+
+        self._configured_nodes = frozenset(nodes)
+        self._discovered_nodes = frozenset()
+        self._rotation = itertools.count()
 
         self._last_check = None
         self._unreachable_nodes = set()
@@ -37,12 +77,54 @@ class ElasticConnection(LoggingAware, object):
         self._reachable_nodes_lock = ReadWriteLock()
         self._unreachable_nodes_lock = ReadWriteLock()
 
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    @property
+    def configured_nodes(self):
+        """Return all nodes which are part of the configuration."""
+        return self._configured_nodes
+
     @property
     def _reachable_nodes(self):
         """Return a list of all currently available nodes."""
         with self._reachable_nodes_lock.readContext:
             return self.nodes.copy()
 
+    def _select_nodes(self):
+        """Return a list of all currently available nodes in the order they should be asked."""
+        nodes = sorted(self._reachable_nodes, key=lambda n: self._node_priorities.get(n, len(self._node_priorities)))
+        if self.round_robin and len(nodes) > 1:
+            offset = next(self._rotation) % len(nodes)
+            nodes = nodes[offset:] + nodes[:offset]
+
+        return nodes
+
+    def update_nodes(self, nodes):
+        """Replace the nodes which have been discovered earlier with the given ones.
+        Nodes which are part of the configuration are never removed.
+
+        """
+        discovered = frozenset(nodes) - self._configured_nodes
+        added, removed = discovered - self._discovered_nodes, self._discovered_nodes - discovered
+        if not added and not removed:
+            return
+
+        with self._unreachable_nodes_lock.writeContext:
+            self._unreachable_nodes.difference_update(removed)
+
+        with self._reachable_nodes_lock.writeContext:
+            for node in added:
+                self._node_priorities.setdefault(node, len(self._node_priorities))
+
+            self.nodes = (self.nodes - removed) | added
+            self._discovered_nodes = discovered
+
+        if added:
+            self.log.info('Discovered new nodes: %s', ', '.join(sorted(added)))
+        if removed:
+            self.log.info('Nodes no longer part of the cluster: %s', ', '.join(sorted(removed)))
+
     def _mark_as_unreachable(self, node):
         """Register the given node as unreachable."""
         with self._reachable_nodes_lock.writeContext:
@@ -93,7 +175,118 @@ class ElasticConnection(LoggingAware, object):
         self._last_check = time.time()
         self._check_flag.clear()
 
-    def process(self, request):
+    def process(self, request, coalesce=False, hedge=False):
+        """Send the given request to Elasticsearch and return its response.
+        Returns None if it was not possible to receive a response.
+
+        If coalesce is True and an identical request is currently being processed, its response is awaited
+        and shared instead of sending the given request as well. If hedge is True and the node the request
+        is sent to is slow to respond, it is sent to another node as well, as permitted by the hedging
+        policy. Only pass True for idempotent requests.
+
+        """
+        if not coalesce:
+            return self._process(request, hedge)
+
+        key = (request.command, request.path, urllib.urlencode(request.query, True), request.body,
+               request.headers.get('Accept-Encoding'))
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            if not self._await_flight(flight, request):
+                return
+
+            if not flight.shared or isinstance(flight.error, requests.Timeout):
+                # The response couldn't be buffered or the identical request exceeded its own deadline,
+                # which is not necessarily ours, so fetch our own response
+                return self._process(request, hedge)
+            elif flight.error is not None:
+                raise flight.error
+            elif flight.response is not None:
+                self.log.debug('Sharing response to identical request "%s %s"...', request.command, request.path)
+                return self._replay(flight.response)
+            return
+
+        try:
+            response = self._process(request, hedge)
+        except requests.RequestException as error:
+            flight.error = error
+            flight.shared = True
+            raise
+        else:
+            if response is None:
+                # If we have been abandoned, identical requests must not go without a response because of that
+                flight.shared = not getattr(request, 'abandoned', False)
+                return
+
+            flight.response = self._buffer(response, request.command == 'HEAD')
+            if flight.response is None:
+                return response
+
+            flight.shared = True
+            return self._replay(flight.response)
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+
+            flight.landed.set()
+
+    def _await_flight(self, flight, request):
+        """Wait until the given flight has landed and return True. Returns False if the given request
+        has been abandoned meanwhile. Raises requests.Timeout if its deadline has been exceeded.
+
+        """
+        deadline = getattr(request, 'deadline', None)
+        while True:
+            if deadline is None:
+                timeout = COALESCING_CHECK_INTERVAL
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise requests.Timeout('Deadline exceeded while waiting for an identical request')
+
+                timeout = min(COALESCING_CHECK_INTERVAL, remaining)
+
+            if flight.landed.wait(timeout):
+                return True
+            elif getattr(request, 'abandoned', False):
+                return False
+
+    def _buffer(self, response, head_only=False):
+        """Read the payload of the given response and return it together with the status and headers.
+        Returns None if the response is too large or of unknown size, leaving it untouched.
+
+        """
+        try:
+            content_length = int(response.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return  # Chunked responses are of unknown size, so they're not buffered
+
+        if content_length > COALESCING_BUFFER_LIMIT:
+            return
+
+        content = response.raw.read(decode_content=False) if content_length and not head_only else ''
+        return response.status_code, response.reason, response.headers.items(), content
+
+    def _replay(self, buffered_response):
+        """Create and return a new response object based on the given buffered response."""
+        status_code, reason, headers, content = buffered_response
+
+        response = requests.Response()
+        response.status_code = status_code
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(headers)
+        response.raw = HTTPResponse(io.BytesIO(content), headers=response.headers, status=status_code,
+                                    reason=reason, preload_content=False, decode_content=False)
+        return response
+
+    def _process(self, request, hedge=False):
         """Send the given request to Elasticsearch and return its response.
         Returns None if it was not possible to receive a response."""
         try:  # It's either a ElasticRequestHandler, a ElasticRequest ..
@@ -120,31 +313,398 @@ class ElasticConnection(LoggingAware, object):
                            request_path + ('?' + encoded_query if encoded_query else ''))
 
         first_error = None
-        with requests.Session() as session:
-            for node in self._reachable_nodes:
-                prepared_request.prepare_url(node + request_path, encoded_query)
-
-                try:
-                    # TODO: Interpret the timeout= query parameter for Elasticsearch
-                    response = session.send(prepared_request, stream=True, timeout=DEFAULT_TIMEOUT)
-                except requests.Timeout:
-                    self.log.warning('Node "%s" timed out.', node)
-                    self._mark_as_unreachable(node)
-                except requests.RequestException as error:
-                    self.log.warning('Failed to connect to node "%s". An error occurred: %s',
-                                     node, format_elasticsearch_error(error))
-                    self._mark_as_unreachable(node)
-                    if first_error is None:
-                        first_error = error
-                else:
-                    self.log.debug('Got response with status %u from node "%s".', response.status_code, node)
+        deadline = getattr(request, 'deadline', None)
+        hedging_policy = self.hedging_policy if hedge else None
+
+        nodes = self._select_nodes()
+        if hedging_policy is not None and len(nodes) > 1:
+            delay = hedging_policy.get_delay()
+            if delay is not None:
+                response, first_error, nodes = self._hedge(request, prepared_request, request_path,
+                                                           encoded_query, nodes, deadline, delay)
+                if response is not None:
                     return response
 
+        for node in nodes:
+            if getattr(request, 'abandoned', False):
+                return
+
+            prepared_request.prepare_url(node + request_path, encoded_query)
+            started_at = time.time()
+            response, error = self._send(prepared_request, node, deadline)
+            if response is not None:
+                if hedging_policy is not None:
+                    hedging_policy.observe(time.time() - started_at)
+                return response
+            elif first_error is None:
+                first_error = error
+
         if first_error is not None:
             # Re-raise the exception which occurred first to indicate
             # to the user that we were not able to fetch a response
             raise first_error
 
+    def _send(self, prepared_request, node, deadline=None):
+        """Send the given prepared request to the given node and return its response and None. Returns None and
+        the error which occurred if the node failed to respond, after marking it as unreachable. (The error is
+        None in case of a timeout) Raises requests.Timeout if the given deadline has been exceeded.
+
+        """
+        if deadline is None:
+            timeout = DEFAULT_TIMEOUT
+        else:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise requests.Timeout('Deadline exceeded before a node responded')
+
+            timeout = (min(DEFAULT_TIMEOUT, remaining), remaining)
+
+        try:
+            with requests.Session() as session:
+                response = session.send(prepared_request, stream=True, timeout=timeout)
+        except requests.exceptions.ReadTimeout:
+            if deadline is not None:
+                # The node is reachable but the request is too slow, another node won't be any faster
+                self.log.warning('Node "%s" did not respond within %.1f seconds.', node, timeout[1])
+                raise
+
+            self.log.warning('Node "%s" timed out.', node)
+            self._mark_as_unreachable(node)
+        except requests.Timeout:
+            self.log.warning('Node "%s" timed out.', node)
+            self._mark_as_unreachable(node)
+        except requests.RequestException as error:
+            self.log.warning('Failed to connect to node "%s". An error occurred: %s',
+                             node, format_elasticsearch_error(error))
+            self._mark_as_unreachable(node)
+            return None, error
+        else:
+            self.log.debug('Got response with status %u from node "%s".', response.status_code, node)
+            return response, None
+
+        return None, None
+
+    def _hedge(self, request, prepared_request, request_path, encoded_query, nodes, deadline, delay):
+        """Send the given request to the first of the given nodes and, if it did not respond within the given
+        delay, to the second one as well. The response received first wins, the other one is closed once it
+        arrives. Returns the winning response, the first error which occurred and the nodes not asked yet.
+
+        """
+        results, lock, state = Queue.Queue(), threading.Lock(), {'decided': False}
+
+        def send(node):
+            attempt = prepared_request.copy()
+            attempt.prepare_url(node + request_path, encoded_query)
+            started_at = time.time()
+            try:
+                response, error = self._send(attempt, node, deadline)
+            except Exception:
+                response, error = None, sys.exc_info()
+            else:
+                if response is not None:
+                    self.hedging_policy.observe(time.time() - started_at)
+
+            with lock:
+                if not state['decided']:
+                    results.put((response, error))
+                elif response is not None:
+                    response.close()
+
+        def ask(node):
+            thread = threading.Thread(target=send, args=(node,), name='HedgedRequest')
+            thread.daemon = True
+            thread.start()
+
+        ask(nodes[0])
+        asked, hedged = 1, False
+        first_error = exc_info = None
+        try:
+            pending = 1
+            while pending:
+                try:
+                    response, error = results.get(timeout=None if hedged else delay)
+                except Queue.Empty:
+                    hedged = True  # Wait for either response from now on
+                    if not getattr(request, 'abandoned', False) and self.hedging_policy.acquire():
+                        self.log.debug('Node "%s" did not respond within %.3f seconds. Hedging request to node'
+                                       ' "%s"...', nodes[0], delay, nodes[1])
+                        ask(nodes[1])
+                        asked += 1
+                        pending += 1
+                    continue
+
+                pending -= 1
+                if response is not None:
+                    return response, None, []
+                elif isinstance(error, tuple):
+                    exc_info = exc_info or error
+                elif first_error is None:
+                    first_error = error
+        finally:
+            with lock:
+                state['decided'] = True
+                while not results.empty():
+                    response, _ = results.get()
+                    if response is not None:
+                        response.close()
+
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        return None, first_error, nodes[asked:]
+
+    def scroll(self, request):
+        """Send the given search request and return a generator yielding all hits, page by page.
+        Raises requests.ConnectionError in case not a single node is reachable.
+
+        """
+        request.params['scroll'] = SCROLL_KEEP_ALIVE
+        request.params['size'] = SCROLL_PAGE_SIZE
+        scroll_params = {'scroll': SCROLL_KEEP_ALIVE, 'filter_path': request.params.get('filter_path')}
+
+        scroll_id = None
+        response = self.process(request)
+
+        try:
+            while True:
+                if response is None:
+                    raise requests.ConnectionError('None of the configured Elasticsearch nodes is reachable')
+
+                response.raise_for_status()
+                result = response.json()
+
+                scroll_id = result.get('_scroll_id')
+                hits = result.get('hits', {}).get('hits', [])
+                for hit in hits:
+                    yield hit
+
+                if not hits or not scroll_id:
+                    break
+
+                response = self.process(requests.Request('GET', '/_search/scroll', params=scroll_params,
+                                                         data=scroll_id))
+        finally:
+            if scroll_id:
+                try:
+                    self.process(requests.Request('DELETE', '/_search/scroll', data=scroll_id))
+                except requests.RequestException:
+                    pass  # Not fatal, the scroll will time out anyway
+
+
+class ClusterMetadata(LoggingAware, object):
+    """Cache of the names of all indices and aliases in the cluster, refreshed periodically in the background."""
+    def __init__(self, connection):
+        self.connection = connection
+
+        self._state = None
+        self._thread = None
+        self._terminator = threading.Event()
+
+    def start(self):
+        """Start refreshing the metadata in the background."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ClusterMetadataThread')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop refreshing the metadata."""
+        self._terminator.set()
+
+    def _run(self):
+        """Refresh the metadata until stopped."""
+        while not self._terminator.is_set():
+            try:
+                self.refresh()
+            except (requests.RequestException, ValueError) as error:
+                self.log.warning('Failed to refresh the cluster metadata. An error occurred: %s',
+                                 format_elasticsearch_error(error))
+
+            self._terminator.wait(METADATA_REFRESH_INTERVAL)
+
+    def refresh(self):
+        """Fetch the names of all indices and aliases and replace the current ones with them."""
+        request = requests.Request('GET', '/_cluster/state/metadata', params={
+            'filter_path': 'metadata.indices.*.state,metadata.indices.*.aliases'})
+        response = self.connection.process(request)
+        if response is None:
+            raise requests.ConnectionError('None of the configured Elasticsearch nodes is reachable')
+
+        response.raise_for_status()
+        indices, aliases = set(), {}
+        for index_name, index_metadata in response.json().get('metadata', {}).get('indices', {}).iteritems():
+            if index_metadata.get('state') == 'open':
+                indices.add(index_name)
+                for alias_name in index_metadata.get('aliases', []):
+                    aliases.setdefault(alias_name, set()).add(index_name)
+
+        # The state is replaced as a whole so that requests either see the old or the new one, but never a mixture
+        self._state = (time.time(), frozenset(indices), dict((k, frozenset(v)) for k, v in aliases.iteritems()),
+                       Cache(METADATA_EXPANSION_CACHE_SIZE))
+
+    def expand(self, filter_string):
+        """Return the given filter string expanded to the fewest existing indices and aliases it matches.
+        Returns None if it does not contain any wildcards, if it contains names which do not exist, if
+        the metadata is not up to date or if the expansion is empty or too long to be part of a request's path.
+
+        """
+        state = self._state
+        if state is None or time.time() - state[0] > METADATA_TTL:
+            return
+
+        _, indices, aliases, expansions = state
+        key = str(filter_string)
+        expansion = expansions.get(key, self)
+        if expansion is self:
+            expansion = self._expand(filter_string, indices, aliases)
+            expansions.set(key, expansion)
+
+        return expansion
+
+    def _expand(self, filter_string, indices, aliases):
+        """Expand the given filter string using the given indices and aliases."""
+        literals = [str(p) for p in filter_string.iter_patterns()]
+        if not any('*' in literal for literal in literals):
+            return
+
+        matches = lambda name: filter_string.matches(FilterString.from_list([name]))
+        matched_indices = set(name for name in indices if matches(name))
+        names = list(matched_indices)
+        for alias_name, alias_indices in aliases.iteritems():
+            # An alias is not required if all of its indices are already part of the expansion
+            if not alias_indices <= matched_indices and matches(alias_name):
+                names.append(alias_name)
+
+        if any('*' not in literal and literal not in indices and literal not in aliases for literal in literals):
+            return  # Elasticsearch should still complain about names unknown to us
+
+        if names:
+            expansion = ','.join(sorted(names))
+            if len(expansion) <= METADATA_EXPANSION_LIMIT:
+                return expansion
+
+
+class NodeSniffer(LoggingAware, object):
+    """Discovers the HTTP enabled nodes of the cluster periodically in the background and
+    passes those of the given type and with the given attributes on to the connection.
+
+    """
+    def __init__(self, connection, interval, node_type='all', attributes=None):
+        self.connection = connection
+        self.interval = interval
+        self.node_type = node_type
+        self.attributes = attributes or {}
+
+        # Discovered nodes are accessed the same way as the configured ones, including credentials and path
+        base_url = urlparse.urlsplit(min(connection.configured_nodes) if connection.configured_nodes else 'http://')
+        self._scheme = base_url.scheme
+        self._userinfo = base_url.netloc.rpartition('@')[0]
+        self._path = base_url.path.rstrip('/')
+        self._thread = None
+        self._terminator = threading.Event()
+
+    def start(self):
+        """Start discovering nodes in the background."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='NodeSnifferThread')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop discovering nodes."""
+        self._terminator.set()
+
+    def _run(self):
+        """Discover nodes until stopped."""
+        while not self._terminator.is_set():
+            try:
+                self.sniff()
+            except (requests.RequestException, ValueError) as error:
+                self.log.warning('Failed to discover the nodes of the cluster. An error occurred: %s',
+                                 format_elasticsearch_error(error))
+
+            self._terminator.wait(self.interval)
+
+    def sniff(self):
+        """Fetch the HTTP addresses of all nodes and pass the matching ones on to the connection."""
+        response = self.connection.process(requests.Request('GET', '/_nodes/http'))
+        if response is None:
+            raise requests.ConnectionError('None of the configured Elasticsearch nodes is reachable')
+
+        response.raise_for_status()
+        configured_addresses = self._resolve_configured_nodes()
+        nodes, matched = [], False
+        for node_info in response.json().get('nodes', {}).itervalues():
+            address = self._get_address(node_info)
+            if address is not None and self._matches(node_info):
+                matched = True
+                if configured_addresses.isdisjoint(self._get_bound_addresses(node_info) | set([address])):
+                    nodes.append('{0}://{1}{2}{3}'.format(self._scheme, self._userinfo + '@' if self._userinfo else '',
+                                                         address, self._path))
+
+        if matched:  # A cluster without any matching node is more likely a misconfiguration
+            self.connection.update_nodes(nodes)
+        else:
+            self.log.warning('None of the nodes of the cluster matches the configured type and attributes.')
+
+    def _resolve_configured_nodes(self):
+        """Return the addresses the configured nodes resolve to, formatted like Elasticsearch formats them.
+        Allows to recognize configured nodes among the discovered ones, as these are known by address only.
+
+        """
+        addresses = set()
+        for node in self.connection.configured_nodes:
+            url = urlparse.urlsplit(node)
+            port = url.port or (443 if url.scheme == 'https' else 80)
+            try:
+                address_infos = socket.getaddrinfo(url.hostname, port, 0, socket.SOCK_STREAM)
+            except socket.error as error:
+                self.log.debug('Failed to resolve the address of node "%s". An error occurred: %s', node, error)
+                continue
+
+            for ip in (info[4][0] for info in address_infos):
+                addresses.add('[{0}]:{1}'.format(ip, port) if ':' in ip else '{0}:{1}'.format(ip, port))
+
+        return addresses
+
+    def _get_address(self, node_info):
+        """Return the published HTTP address of the given node or None if it has none."""
+        address = node_info.get('http', {}).get('publish_address') or node_info.get('http_address')
+        if address:
+            return self._parse_address(address)
+
+    def _get_bound_addresses(self, node_info):
+        """Return all HTTP addresses the given node is listening on."""
+        bound_addresses = node_info.get('http', {}).get('bound_address') or []
+        if isinstance(bound_addresses, basestring):
+            bound_addresses = [bound_addresses]  # Elasticsearch 1.x reports a single address only
+
+        return set(self._parse_address(address) for address in bound_addresses)
+
+    def _parse_address(self, address):
+        """Return the given address as reported by Elasticsearch without a hostname."""
+        # Elasticsearch 1.x formats addresses as "inet[hostname/ip:port]"
+        address = address.replace('inet[', '').rstrip(']') if address.startswith('inet[') else address
+        return address.rsplit('/', 1)[-1]
+
+    def _matches(self, node_info):
+        """Return whether the given node is of the desired type and has all desired attributes."""
+        attributes = node_info.get('attributes', {})
+        if any(attributes.get(name) != value for name, value in self.attributes.iteritems()):
+            return False
+        elif self.node_type == 'all':
+            return True
+
+        if 'roles' in node_info:  # Elasticsearch 5.x+
+            is_data, is_master = 'data' in node_info['roles'], 'master' in node_info['roles']
+        else:
+            is_data = attributes.get('data', 'true') != 'false'
+            is_master = attributes.get('master', 'true') != 'false'
+
+        if self.node_type == 'data':
+            return is_data
+        return not is_data and not is_master
+
 
 class ElasticObject(LoggingAware, object):
     """Base class for all objects stored in our internal Elasticsearch index."""
@@ -171,6 +731,11 @@ class ElasticObject(LoggingAware, object):
         """Create and return a new get request to fetch the given document's source."""
         return cls.request(urllib.quote(id, '') + '/_source', method='GET')
 
+    @classmethod
+    def multi_get(cls, ids, **params):
+        """Create and return a new multi get request to fetch the given documents at once."""
+        return cls.request('_mget', method='GET', params=params, json={'ids': ids})
+
     @classmethod
     def from_source(cls, id, source):
         """Create and return a new instance of this class using
@@ -207,11 +772,12 @@ class ElasticRole(ElasticObject):
     """ElasticRole object representing a client's role."""
     document_type = CONFIGURATION_TYPE_ROLE
 
-    def __init__(self, id, privileges):
+    def __init__(self, id, privileges, limits=None):
         super(ElasticRole, self).__init__(id)
         self.users = None
         self.groups = None
         self.privileges = privileges
+        self.limits = limits
 
     @classmethod
     def search(cls, user=None, groups=None):
@@ -249,13 +815,71 @@ class ElasticRole(ElasticObject):
             }
 
         query_params = {
-            'filter_path': 'hits.hits._id,hits.hits._source',
-            '_source': 'privileges'
+            'filter_path': '_scroll_id,hits.hits._id,hits.hits._source',
+            '_source': 'privileges,limits'
         }
 
         return cls.request('_search', method='GET', params=query_params, json=data)
 
 
+class ElasticRoleMembership(ElasticObject):
+    """ElasticRoleMembership object representing the roles a single user or group is a member of.
+
+    These documents are maintained by ElasticArmor itself and are derived from
+    all role_user and role_group documents. They allow to fetch the roles of a
+    client with a single multi get request instead of a parent/child query.
+    """
+    document_type = CONFIGURATION_TYPE_ROLE_MEMBERSHIP
+
+    def __init__(self, id, roles):
+        super(ElasticRoleMembership, self).__init__(id)
+        self.roles = roles
+
+    @staticmethod
+    def create_id(principal_type, name):
+        """Create and return the document id for the given type of principal ('user' or 'group') and name."""
+        if isinstance(name, str):
+            name = name.decode('utf-8', 'replace')
+
+        # Names are compared case-insensitively, just like the lowercase_keyword analyzer does
+        return u'{0}:{1}'.format(principal_type, name.lower())
+
+    @classmethod
+    def search_assignments(cls):
+        """Create and return a new search request to fetch the user and group assignments of all roles."""
+        query_params = {
+            'filter_path': '_scroll_id,hits.hits._type,hits.hits._parent,hits.hits.fields,hits.hits._source',
+            'fields': '_parent',
+            '_source': 'name'
+        }
+
+        return cls.request(method='GET', params=query_params, url='/{0}/{1},{2}/_search'.format(
+            cls.index_name, CONFIGURATION_TYPE_ROLE_USER, CONFIGURATION_TYPE_ROLE_GROUP))
+
+    @classmethod
+    def search_ids(cls):
+        """Create and return a new search request to fetch the ids of all existing membership documents."""
+        query_params = {
+            'filter_path': '_scroll_id,hits.hits._id',
+            '_source': 'false'
+        }
+
+        return cls.request('_search', method='GET', params=query_params)
+
+    @classmethod
+    def bulk_update(cls, memberships, obsolete_ids=None):
+        """Create and return a new bulk request to store the given memberships and to delete the given ids."""
+        lines = []
+        for membership in memberships:
+            lines.append(json.dumps({'index': {'_id': membership.id}}))
+            lines.append(json.dumps({'roles': sorted(membership.roles)}))
+
+        for id in obsolete_ids or []:
+            lines.append(json.dumps({'delete': {'_id': id}}))
+
+        return cls.request('_bulk', method='POST', data='\n'.join(lines) + '\n')
+
+
 class ElasticUser(ElasticObject):
     """ElasticUser object representing a user account."""
     document_type = CONFIGURATION_TYPE_USER
@@ -271,6 +895,62 @@ class ElasticUser(ElasticObject):
         return user
 
 
+class QueryCost(object):
+    """QueryCost object to estimate how expensive it is for Elasticsearch to process a search request.
+
+    It is populated by the parsers while they walk a request's body:
+
+        parser = AggregationParser().aggregations(json_body['aggregations'])
+        parser.cost.buckets -> <estimated-number-of-buckets>
+
+    Buckets are estimated by multiplying the sizes of nested aggregations. Aggregations whose number of buckets
+    depends on the data (e.g. histograms) count as a single one. The cost of multiple parsers can be combined
+    using method update().
+    """
+
+    __slots__ = ('aggregation_depth', 'buckets', 'result_window', 'top_hits', 'scripts', 'leading_wildcards')
+
+    # Maps the names of budgets which may be defined by roles to the attributes they limit
+    budgets = [
+        ('max_aggregation_depth', 'aggregation_depth', 'an aggregation depth of {0}'),
+        ('max_buckets', 'buckets', '{0} aggregation buckets'),
+        ('max_result_window', 'result_window', 'a result window (from + size) of {0}'),
+        ('max_top_hits', 'top_hits', '{0} top hits'),
+        ('max_scripts', 'scripts', '{0} scripts'),
+        ('max_leading_wildcards', 'leading_wildcards', '{0} wildcard or regexp patterns with a leading wildcard')
+    ]
+
+    def __init__(self):
+        self.aggregation_depth = 0
+        self.buckets = 0
+        self.result_window = 0
+        self.top_hits = 0
+        self.scripts = 0
+        self.leading_wildcards = 0
+
+    def __repr__(self):
+        return '<QueryCost {0}>'.format(', '.join('{0}={1}'.format(n, getattr(self, n)) for n in self.__slots__))
+
+    def update(self, other):
+        """Add the given cost to this one."""
+        self.aggregation_depth = max(self.aggregation_depth, other.aggregation_depth)
+        self.result_window = max(self.result_window, other.result_window)
+        self.buckets += other.buckets
+        self.top_hits += other.top_hits
+        self.scripts += other.scripts
+        self.leading_wildcards += other.leading_wildcards
+
+    def exceeds(self, limits):
+        """Return a description of the first of the given budgets this cost exceeds, or None if there is none.
+        Raises ValueError in case a budget is invalid.
+
+        """
+        for budget_name, attribute_name, description in self.budgets:
+            budget = limits.get(budget_name)
+            if budget is not None and getattr(self, attribute_name) > int(budget):
+                return description.format(int(budget))
+
+
 # TODO: Be more strict if it's about irrelevant top-level keywords!
 class QueryDslParser(object):
     """QueryDslParser object to parse Elasticsearch queries and filters.
@@ -314,6 +994,7 @@ class QueryDslParser(object):
         self.indices = set()
         self.documents = set()
         self.fields = set()
+        self.cost = QueryCost()
 
         self._query_parsers = {
             'query': self.query,
@@ -394,6 +1075,20 @@ class QueryDslParser(object):
             'type': self.type_filter
         }
 
+    def _use_script(self, index=None, document=None):
+        """Register the usage of a script in the given context."""
+        self.permissions.add(('api/feature/script', index, document, None))
+        self.cost.scripts += 1
+
+    def _inspect_pattern(self, obj, field_name, leading_wildcards):
+        """Register the pattern of the given field in case it starts with any of the given wildcards."""
+        pattern = obj[field_name]
+        if isinstance(pattern, dict):
+            pattern = pattern.get('value', pattern.get('wildcard', pattern.get('regexp')))
+
+        if isinstance(pattern, basestring) and (not pattern or pattern.startswith(leading_wildcards)):
+            self.cost.leading_wildcards += 1
+
     def _parse_query(self, name, obj, index=None, document=None):
         """Parse the given query. Raises ElasticSearchError if it is unknown."""
         try:
@@ -546,7 +1241,7 @@ class QueryDslParser(object):
     def _parse_score_function(self, obj, index, document):
         """Parse the given score function and return whether it was a success."""
         if 'script_score' in obj:
-            self.permissions.add(('api/feature/script', index, document, None))
+            self._use_script(index, document)
         elif 'field_value_factor' in obj:
             try:
                 self.fields.add((index, document, obj['field_value_factor']['field']))
@@ -786,6 +1481,7 @@ class QueryDslParser(object):
         field_name = self._read_field(obj)
         if field_name:
             self.fields.add((index, document, field_name))
+            self._inspect_pattern(obj, field_name, '.')
         else:
             raise ElasticSearchError('Missing field name in regexp query "{0!r}"'.format(obj))
 
@@ -871,6 +1567,7 @@ class QueryDslParser(object):
         field_name = self._read_field(obj, ['rewrite'])
         if field_name:
             self.fields.add((index, document, field_name))
+            self._inspect_pattern(obj, field_name, ('*', '?'))
         else:
             raise ElasticSearchError('Missing field name in wildcard query "{0!r}"'.format(obj))
 
@@ -1130,12 +1827,13 @@ class QueryDslParser(object):
         field_name = self._read_field(obj)
         if field_name:
             self.fields.add((index, document, field_name))
+            self._inspect_pattern(obj, field_name, '.')
         else:
             raise ElasticSearchError('Missing field name in regexp filter "{0!r}"'.format(obj))
 
     def script_filter(self, obj, index=None, document=None):
         """Parse the given script filter."""
-        self.permissions.add(('api/feature/script', index, document, None))
+        self._use_script(index, document)
 
     def term_filter(self, obj, index=None, document=None):
         """Parse the given term filter. Raises ElasticSearchError in case the filter is malformed."""
@@ -1210,6 +1908,10 @@ class AggregationParser(object):
         self.documents = set()
         self.fields = set()
         self.document_requests = []
+        self.cost = QueryCost()
+
+        self._depth = 0
+        self._parent_buckets = 1
 
         self._parsers = {
             'aggregations': self.aggregations,
@@ -1272,6 +1974,25 @@ class AggregationParser(object):
 
         return agg_name, obj[agg_name]
 
+    def _use_script(self, index=None, document=None, field=None):
+        """Register the usage of a script in the given context."""
+        self.permissions.add(('api/feature/script', index, document, field))
+        self.cost.scripts += 1
+
+    def _estimate_buckets(self, name, obj):
+        """Return the number of buckets the given aggregation creates at most, or one if that is unknown."""
+        try:
+            if name in ('terms', 'significant_terms', 'geohash_grid'):
+                return int(obj.get('size', 10000 if name == 'geohash_grid' else 10)) or UNBOUNDED_SIZE
+            elif name in ('range', 'date_range', 'ip_range', 'geo_distance'):
+                return len(obj.get('ranges', ())) or 1
+            elif name == 'filters':
+                return len(obj['filters']) or 1
+        except (TypeError, ValueError):
+            pass
+
+        return 1
+
     def _validate_keywords(self, name, obj, known_keywords):
         """Check whether the given aggregation contains any unknown keywords and raise ElasticSearchError if so."""
         unknown_keyword = next((k for k in obj.iterkeys() if k not in known_keywords), None)
@@ -1295,7 +2016,7 @@ class AggregationParser(object):
             self.fields.add((index, document, field))
 
         if 'script' in obj or 'script_id' in obj or 'script_path' in obj:
-            self.permissions.add(('api/feature/script', index, document, field))
+            self._use_script(index, document, field)
 
         return index, document, field
 
@@ -1308,12 +2029,31 @@ class AggregationParser(object):
             raise ElasticSearchError('Invalid JSON object "{0!r}"'.format(obj))
 
         current_context = (index, document, field)
-        for agg_body in obj.itervalues():
-            new_context = self._parse_aggregation(*self._read_aggregation(agg_body),
-                                                  index=index, document=document, field=field)
-
-            if 'aggs' in agg_body or 'aggregations' in agg_body:
-                self.aggregations(agg_body.get('aggs', agg_body.get('aggregations')), *(new_context or current_context))
+        parent_buckets = self._parent_buckets
+        self._depth += 1
+        self.cost.aggregation_depth = max(self.cost.aggregation_depth, self._depth)
+        try:
+            for agg_body in obj.itervalues():
+                agg_name, agg_obj = self._read_aggregation(agg_body)
+                new_context = self._parse_aggregation(agg_name, agg_obj, index=index, document=document, field=field)
+
+                buckets = parent_buckets * self._estimate_buckets(agg_name, agg_obj)
+                self.cost.buckets += buckets
+                if agg_name == 'top_hits':
+                    try:
+                        self.cost.top_hits += parent_buckets * int(agg_obj.get('size', 3))
+                    except (TypeError, ValueError):
+                        pass
+
+                if 'aggs' in agg_body or 'aggregations' in agg_body:
+                    self._parent_buckets = buckets
+                    try:
+                        self.aggregations(agg_body.get('aggs', agg_body.get('aggregations')),
+                                          *(new_context or current_context))
+                    finally:
+                        self._parent_buckets = parent_buckets
+        finally:
+            self._depth -= 1
 
     def min_agg(self, obj, index=None, document=None, field=None):
         """Parse the given min aggregation. Raises ElasticSearchError in case it is malformed."""
@@ -1378,7 +2118,7 @@ class AggregationParser(object):
             self.permissions.add(('api/search/explain', index, document, field))
 
         if 'script_fields' in obj:
-            self.permissions.add(('api/feature/script', index, document, field))
+            self._use_script(index, document, field)
 
         if 'sort' in obj:
             if isinstance(obj['sort'], list):
@@ -1394,7 +2134,7 @@ class AggregationParser(object):
 
     def scripted_metric_agg(self, obj, index=None, document=None, field=None):
         """Parse the given scripted_metric aggregation."""
-        self.permissions.add(('api/feature/script', index, document, field))
+        self._use_script(index, document, field)
 
     def global_agg(self, obj, index=None, document=None, field=None):
         """Parse the given global aggregation. Raises ElasticSearchError in case it is malformed."""
@@ -1409,6 +2149,7 @@ class AggregationParser(object):
         self.indices |= parser.indices
         self.documents |= parser.documents
         self.fields |= parser.fields
+        self.cost.update(parser.cost)
 
     def filters_agg(self, obj, index=None, document=None, field=None):
         """Parse the given filters aggregation. Raises ElasticSearchError in case it is malformed."""
@@ -1432,6 +2173,7 @@ class AggregationParser(object):
             self.indices |= parser.indices
             self.documents |= parser.documents
             self.fields |= parser.fields
+            self.cost.update(parser.cost)
 
     def missing_agg(self, obj, index=None, document=None, field=None):
         """Parse the given missing aggregation. Raises ElasticSearchError in case it is malformed."""
@@ -1504,7 +2246,7 @@ class AggregationParser(object):
             self.fields.add((index, document, field))
 
         if 'script' in obj or 'script_id' in obj or 'script_file' in obj:
-            self.permissions.add(('api/feature/script', index, document, field))
+            self._use_script(index, document, field)
 
         return index, document, field
 
@@ -1525,7 +2267,7 @@ class AggregationParser(object):
             self.fields.add((index, document, field))
 
         if 'script_heuristic' in obj:
-            self.permissions.add(('api/feature/script', index, document, field))
+            self._use_script(index, document, field)
 
         if 'background_filter' in obj:
             parser = QueryDslParser()
@@ -1534,6 +2276,7 @@ class AggregationParser(object):
             self.indices |= parser.indices
             self.documents |= parser.documents
             self.fields |= parser.fields
+            self.cost.update(parser.cost)
 
         return index, document, field
 
@@ -1553,7 +2296,7 @@ class AggregationParser(object):
             self.fields.add((index, document, field))
 
         if 'script' in obj or 'script_id' in obj or 'script_file' in obj:
-            self.permissions.add(('api/feature/script', index, document, field))
+            self._use_script(index, document, field)
 
         return index, document, field
 
@@ -1573,7 +2316,7 @@ class AggregationParser(object):
             self.fields.add((index, document, field))
 
         if 'script' in obj or 'script_id' in obj or 'script_file' in obj:
-            self.permissions.add(('api/feature/script', index, document, field))
+            self._use_script(index, document, field)
 
         return index, document, field
 
@@ -1592,7 +2335,7 @@ class AggregationParser(object):
             self.fields.add((index, document, field))
 
         if 'script' in obj or 'script_id' in obj or 'script_file' in obj:
-            self.permissions.add(('api/feature/script', index, document, field))
+            self._use_script(index, document, field)
 
         return index, document, field
 
@@ -1612,7 +2355,7 @@ class AggregationParser(object):
             self.fields.add((index, document, field))
 
         if 'script' in obj or 'script_id' in obj or 'script_file' in obj:
-            self.permissions.add(('api/feature/script', index, document, field))
+            self._use_script(index, document, field)
 
         return index, document, field
 
@@ -1633,7 +2376,7 @@ class AggregationParser(object):
             self.fields.add((index, document, field))
 
         if 'script' in obj or 'script_id' in obj or 'script_file' in obj:
-            self.permissions.add(('api/feature/script', index, document, field))
+            self._use_script(index, document, field)
 
         return index, document, field
 
@@ -1912,6 +2655,7 @@ class FilterString(object):
         self._parts = parts or []
         self._update_order = None
         self._max_position = None
+        self._index = None
 
         self.combined = []
 
@@ -1954,9 +2698,22 @@ class FilterString(object):
         if self._update_order or self._update_order is None:
             self._parts = sorted(self._parts, key=lambda p: p.order)
             self._update_order = False
+            self._index = None
 
         return self._parts
 
+    @property
+    def _lookup_index(self):
+        """The index of this filter string's parts or None if there are too few parts to justify one."""
+        parts = self._sorted
+        if len(parts) < FILTER_STRING_INDEX_THRESHOLD:
+            return
+
+        if self._index is None:
+            self._index = _PartIndex(parts)
+
+        return self._index
+
     @property
     def _last_position(self):
         if self._max_position is None:
@@ -1995,14 +2752,17 @@ class FilterString(object):
 
     def append_include(self, pattern):
         """Append a new include pattern to this filter string."""
+        self._index = None
         self._parts.append(_Part('include', self._create_pattern(pattern), self._next_position))
 
     def append_exclude(self, pattern):
         """Append a new exclude pattern to this filter string."""
+        self._index = None
         self._parts.append(_Part('exclude', self._create_pattern(pattern), self._last_position + self.exclude_step))
 
     def append_addition(self, pattern):
         """Append a new addition pattern to this filter string."""
+        self._index = None
         self._parts.append(_Part('addition', self._create_pattern(pattern), self._last_position + self.addition_step))
 
     def iter_patterns(self, skip_excludes=True):
@@ -2016,9 +2776,16 @@ class FilterString(object):
             if existing_part.is_exclude():
                 new_parts.append(existing_part)
             else:
+                index = filter_string._lookup_index
+                if index is not None and (index.exact or type(existing_part.pattern) is _Pattern):
+                    # Parts which are not related to the existing one do not have any effect below
+                    related_parts = index.get_related_runs(existing_part.pattern)
+                else:
+                    related_parts = filter_string
+
                 candidates = []
                 register_excludes = exit_after_excludes = False
-                for new_part in filter_string:
+                for new_part in related_parts:
                     # TODO: Take new_part.order into consideration to achieve some sort of stability
                     if new_part.is_exclude():
                         if register_excludes:
@@ -2057,6 +2824,7 @@ class FilterString(object):
 
         self._parts = new_parts
         self._update_order = True
+        self._index = None
         self.combined = list(combined)
         return True
 
@@ -2066,8 +2834,15 @@ class FilterString(object):
             return True
 
         for pattern in filter_string.iter_patterns():
+            index = self._lookup_index
+            if index is not None and (index.exact or type(pattern) is _Pattern):
+                # Parts whose pattern cannot match the given one do not have any effect below
+                candidates = index.get_candidates(pattern)
+            else:
+                candidates = self._sorted
+
             match_found = False
-            for part in self._sorted:
+            for part in candidates:
                 if match_found and part.is_exclude():
                     if part.pattern >= pattern:
                         match_found = False
@@ -2082,7 +2857,100 @@ class FilterString(object):
         return True
 
 
+class _PatternTrie(object):
+    """Trie of strings, each associated with one or more values."""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, key, value):
+        """Associate the given value with the given key."""
+        node = self._root
+        for char in key:
+            node = node.setdefault(char, {})
+
+        node.setdefault(None, []).append(value)
+
+    def get_prefixes_of(self, subject):
+        """Return the values of all keys the given subject starts with."""
+        node = self._root
+        values = list(node.get(None, ()))
+        for char in subject:
+            node = node.get(char)
+            if node is None:
+                break
+
+            values.extend(node.get(None, ()))
+
+        return values
+
+    def get_extensions_of(self, prefix):
+        """Return the values of all keys which start with the given prefix."""
+        node = self._root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+
+        values, nodes = [], [node]
+        while nodes:
+            for char, child in nodes.pop().iteritems():
+                if char is None:
+                    values.extend(child)
+                else:
+                    nodes.append(child)
+
+        return values
+
+
+class _PartIndex(object):
+    """Index of the parts of a filter string, organized by the literal prefixes of their patterns.
+
+    A pattern can only match another one if the other one starts with the pattern's literal
+    prefix, i.e. everything up to its first wildcard. Patterns starting with a wildcard have
+    an empty prefix and thus end up in a bucket at the root of the trie, which is always
+    considered. This allows to skip most comparisons when dealing with long lists of
+    indices, which in turn only works if comparing patterns depends on their string
+    representation alone. (See exact)
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.exact = all(type(part.pattern) is _Pattern for part in parts)
+
+        self._prefixes = _PatternTrie()
+        self._runs = []  # Each include or addition, followed by its excludes
+        self._run_prefixes = _PatternTrie()
+        self._run_patterns = _PatternTrie()
+        for position, part in enumerate(parts):
+            pattern = str(part.pattern)
+            prefix = pattern.partition('*')[0]
+            self._prefixes.add(prefix, position)
+            if not part.is_exclude():
+                self._run_prefixes.add(prefix, len(self._runs))
+                self._run_patterns.add(pattern, len(self._runs))
+                self._runs.append([part])
+            elif self._runs:
+                self._runs[-1].append(part)
+
+    def get_candidates(self, pattern):
+        """Return all parts, in order, whose pattern may match the given one."""
+        return [self.parts[position] for position in sorted(self._prefixes.get_prefixes_of(str(pattern)))]
+
+    def get_related_runs(self, pattern):
+        """Return all parts, in order, of the runs whose first
+        pattern may match or be matched by the given one.
+
+        """
+        pattern = str(pattern)
+        runs = set(self._run_prefixes.get_prefixes_of(pattern))
+        runs.update(self._run_patterns.get_extensions_of(pattern.partition('*')[0]))
+        return [part for run in sorted(runs) for part in self._runs[run]]
+
+
 class _Part(object):
+    __slots__ = ('type', 'pattern', 'order')
+
     def __init__(self, pattern_type, pattern, order=0):
         self.type = pattern_type
         self.pattern = pattern
@@ -2110,8 +2978,10 @@ class _Part(object):
 
 
 class _Pattern(object):
+    __slots__ = ('pattern',)
+
     def __init__(self, pattern):
-        self.pattern = str(pattern)
+        self.pattern = intern(str(pattern))
 
     def __str__(self):
         return self.pattern
@@ -0,0 +1,62 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import collections
+import threading
+
+from elasticarmor.util.mixins import LoggingAware
+
+__all__ = ['HedgingPolicy']
+
+HEDGING_SAMPLE_SIZE = 1000  # Latencies, the percentile is calculated from
+HEDGING_MIN_SAMPLES = 100  # Latencies, required before any request is hedged
+HEDGING_MAX_TOKENS = 10  # Hedges, which may be issued in a row once enough tokens accumulated
+HEDGING_UPDATE_INTERVAL = 50  # Latencies, observed before the percentile is calculated again
+
+
+class HedgingPolicy(LoggingAware, object):
+    """Decides when and how often a request, whose node is slow to respond, is sent to another node as well.
+
+    A request is hedged once it took longer than the given percentile of the latencies observed recently. To
+    avoid doubling the load of Elasticsearch in case all nodes are slow, the number of hedged requests is
+    limited to the given percentage of all requests.
+    """
+
+    def __init__(self, percentile, budget):
+        self.percentile = percentile
+        self.budget = budget
+
+        self._latencies = collections.deque(maxlen=HEDGING_SAMPLE_SIZE)
+        self._tokens = 0.0
+        self._delay = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def observe(self, latency):
+        """Register the given time a node took to respond."""
+        with self._lock:
+            self._latencies.append(latency)
+            self._pending += 1
+
+    def get_delay(self):
+        """Return the number of seconds to wait for a response before hedging a request.
+        Returns None if not enough latencies have been observed yet.
+
+        """
+        with self._lock:
+            self._tokens = min(HEDGING_MAX_TOKENS, self._tokens + self.budget / 100.0)
+            if len(self._latencies) >= HEDGING_MIN_SAMPLES and (
+                    self._delay is None or self._pending >= HEDGING_UPDATE_INTERVAL):
+                self._pending = 0
+                latencies = sorted(self._latencies)
+                self._delay = latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))]
+
+            return self._delay
+
+    def acquire(self):
+        """Return whether a request may be hedged now, accounting for it if so."""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            return True
@@ -0,0 +1,74 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import json
+import mmap
+import os
+import struct
+import zlib
+
+__all__ = ['SnapshotError', 'write_snapshot', 'read_snapshot']
+
+SNAPSHOT_MAGIC = 'EASNAP'
+SNAPSHOT_VERSION = 1
+
+# Magic, format version, payload length and CRC32 checksum of the payload
+_HEADER = struct.Struct('>6sHIi')
+
+
+class SnapshotError(Exception):
+    """Raised by function read_snapshot() in case a snapshot file is invalid."""
+    pass
+
+
+def write_snapshot(path, data):
+    """Write the given JSON serializable data as snapshot to the given path.
+
+    The file is replaced atomically and is only readable by the current user.
+    """
+    payload = json.dumps(data, separators=(',', ':'))
+    header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(payload), zlib.crc32(payload))
+
+    temporary_path = path + '.tmp'
+    with os.fdopen(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb') as f:
+        f.write(header)
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(temporary_path, path)
+
+
+def read_snapshot(path):
+    """Read and return the data of the snapshot at the given path.
+
+    Raises SnapshotError if the file is not a snapshot, has been written
+    by an incompatible version or if its checksum does not match.
+    """
+    with open(path, 'rb') as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # The file is empty
+            raise SnapshotError('File "{0}" is not a snapshot'.format(path))
+
+    try:
+        if len(buffer) < _HEADER.size:
+            raise SnapshotError('File "{0}" is not a snapshot'.format(path))
+
+        magic, version, length, checksum = _HEADER.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError('File "{0}" is not a snapshot'.format(path))
+        elif version != SNAPSHOT_VERSION:
+            raise SnapshotError('Snapshot "{0}" has an unsupported version ({1})'.format(path, version))
+        elif len(buffer) != _HEADER.size + length:
+            raise SnapshotError('Snapshot "{0}" is truncated'.format(path))
+
+        payload = buffer[_HEADER.size:]
+        if zlib.crc32(payload) != checksum:
+            raise SnapshotError('Snapshot "{0}" is corrupt, its checksum does not match'.format(path))
+    finally:
+        buffer.close()
+
+    try:
+        return json.loads(payload)
+    except ValueError as error:
+        raise SnapshotError('Snapshot "{0}" is corrupt. {1}'.format(path, error))
@@ -44,6 +44,7 @@ class RoleForm extends RepositoryForm
         'api/cluster/health'            => 'indices',
         'api/cluster/state'             => 'cluster',
         'api/cluster/stats'             => 'cluster',
+        'api/cluster/quotas'            => 'cluster',
         'api/cluster/pendingTasks'      => 'cluster',
         'api/cluster/reroute'           => 'cluster',
         'api/cluster/get/settings'      => 'cluster',